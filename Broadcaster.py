@@ -0,0 +1,281 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+from telegram import InlineKeyboardMarkup, ParseMode
+from telegram.error import BadRequest, RetryAfter, TimedOut, Unauthorized
+
+
+class TokenBucket:
+    '''A thread-safe token bucket.
+
+    `reserve` always takes a token and returns how long the caller has to
+    wait before using it, so callers are served in the order they asked.'''
+
+    def __init__(self, rate, capacity = 1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = Lock()
+
+    def reserve(self, tokens = 1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self, tokens = 1):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        'Drain the bucket so nobody gets a token for `seconds`'
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def is_full(self):
+        'True if the bucket is like a new one'
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.last) * self.rate >= self.capacity
+
+
+class BroadcastReport:
+    # errors of this many failed chats are kept for the summary
+    MAX_ERRORS = 10
+
+    def __init__(self):
+        self.chats = 0
+        self.messages = 0
+        self.failed = 0
+        self.dead = []
+        # (chat_id, exception) of the first failed chats
+        self.errors = []
+        self.started = time.monotonic()
+        self.finished = None
+        self.lock = Lock()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def throughput(self):
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f'{self.chats} chats, {self.messages} messages, {self.failed} failed, '
+            f'{len(self.dead)} removed in {self.elapsed:.1f}s ({self.throughput:.1f} msg/s)')
+
+
+class Broadcaster:
+    '''Send the same messages to many chats at once.
+
+    Every send takes a token from the global bucket (Telegram allows about
+    30 messages per second for a bot) and from a bucket of its chat (about
+    one message per second in a private chat and 20 per minute in a group).
+    The messages of one chat are always sent in order by a single worker.'''
+
+    # buckets of chats are pruned when there are this many
+    MAX_BUCKETS = 10000
+
+    def __init__(
+        self,
+        bot,
+        workers = 32,
+        global_rate = 30,
+        chat_rate = 1,
+        group_rate = 20/60,
+        max_retries = 3,
+        file_ids = None,
+        on_error = None,
+        http = None,
+        max_image_size = 10*1024*1024):
+
+        self.bot = bot
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        # buckets of chats are shared by all broadcasts, so two broadcasts
+        # at the same time do not send to a chat faster than its rate
+        self.chat_buckets = dict()
+        self.buckets_lock = Lock()
+        self.prune_at = self.MAX_BUCKETS
+        self.max_retries = max_retries
+        self.file_ids = file_ids
+        self.on_error = on_error
+        # images that telegram can not download are downloaded with this client and uploaded
+        self.http = http
+        self.max_image_size = max_image_size
+        self.logger = logging.getLogger('RSSBot.Broadcaster')
+
+    @staticmethod
+    def is_group(chat_id):
+        # groups, supergroups and channels have negative ids
+        return str(chat_id).startswith('-')
+
+    def chat_bucket(self, chat_id):
+        with self.buckets_lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) >= self.prune_at:
+                    # a full bucket is the same as a new one
+                    for key in [key for key, old in self.chat_buckets.items() if old.is_full()]:
+                        del self.chat_buckets[key]
+                    self.prune_at = max(self.MAX_BUCKETS, 2 * len(self.chat_buckets))
+                if self.is_group(chat_id):
+                    bucket = TokenBucket(self.group_rate, 20)
+                else:
+                    bucket = TokenBucket(self.chat_rate, 1)
+                self.chat_buckets[chat_id] = bucket
+            return bucket
+
+    def send_message(self, chat_id, msg):
+        markup = InlineKeyboardMarkup(msg['markup']) if msg.get('markup') else None
+        if msg['type'] == 'text':
+            return self.bot.send_message(
+                chat_id,
+                msg['text'],
+                parse_mode = msg.get('parse_mode', ParseMode.HTML),
+                reply_markup = markup,
+                disable_web_page_preview = True
+            )
+        elif msg['type'] == 'image':
+            return self.send_photo(chat_id, msg, markup)
+
+    def send_photo(self, chat_id, msg, markup):
+        def send(photo):
+            return self.bot.send_photo(
+                chat_id,
+                photo,
+                msg['text'] or None,
+                parse_mode = msg.get('parse_mode', ParseMode.HTML),
+                reply_markup = markup
+            )
+
+        def send_url(url):
+            try:
+                return send(url)
+            except BadRequest as e:
+                # telegram could not get the image (blocked, too slow or too big)
+                if self.http is None or not any(text in str(e).lower() for text in ('http url', 'web page content')):
+                    raise
+                with self.http.request(url, max_body = self.max_image_size) as response:
+                    image = response.read()
+                return send(image)
+
+        url = msg['src']
+        if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+            # already a file_id (or a file)
+            return send(url)
+        if self.file_ids is None:
+            return send_url(url)
+
+        file_id = self.file_ids.get(url)
+        if file_id is None:
+            # Only one worker makes telegram download the image, the others
+            # wait for its file_id
+            with self.file_ids.lock_for(url):
+                file_id = self.file_ids.get(url)
+                if file_id is None:
+                    message = send_url(url)
+                    if message and message.photo:
+                        self.file_ids.put(url, message.photo[-1].file_id)
+                    return message
+        try:
+            return send(file_id)
+        except BadRequest:
+            # file_id is not valid anymore
+            self.file_ids.discard(url)
+            return send_url(url)
+
+    def send(self, chat_id, msg, bucket):
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            self.global_bucket.acquire()
+            try:
+                return self.send_message(chat_id, msg)
+            except RetryAfter as e:
+                # flood control hit; stop everybody, not just this worker
+                self.logger.warning(f'Flood control exceeded, retrying in {e.retry_after} seconds')
+                self.global_bucket.pause(e.retry_after)
+                if attempt == self.max_retries:
+                    raise
+            except TimedOut:
+                if attempt == self.max_retries:
+                    raise
+
+    def send_chat(self, chat_id, chat_data, messages, report):
+        bucket = self.chat_bucket(chat_id)
+        sent = 0
+        try:
+            for msg in messages:
+                self.send(chat_id, msg, bucket)
+                sent += 1
+        except Unauthorized as e:
+            # the bot is blocked or removed from the chat, it is removed
+            self.logger.info(f'Removing chat {chat_id}: {e}')
+            with report.lock:
+                report.dead.append(chat_id)
+        except Exception as e:
+            self.logger.warning(f'Could not send to chat {chat_id}: {e!r}')
+            with report.lock:
+                report.failed += 1
+                if len(report.errors) < report.MAX_ERRORS:
+                    report.errors.append((chat_id, e))
+        finally:
+            with report.lock:
+                report.chats += 1
+                report.messages += sent
+
+    def error(self, exc, msg, report = True, **kwargs):
+        if self.on_error:
+            try:
+                self.on_error(exc, msg, report, **kwargs)
+                return
+            except Exception:
+                self.logger.exception('Exception while reporting an error')
+        self.logger.exception(msg, exc_info=exc)
+
+    def broadcast(self, messages, chats, on_done = None) -> BroadcastReport:
+        '''Send `messages` to every (chat_id, chat_data) in `chats`.
+
+        `on_done(chat_id)` is called when a chat is done, even if it failed.
+        Blocks until all chats are done and returns a `BroadcastReport`.'''
+        report = BroadcastReport()
+        # do not read more chats than the workers can handle
+        slots = BoundedSemaphore(self.workers * 2)
+
+        def task(chat_id, chat_data):
+            try:
+                try:
+                    self.send_chat(chat_id, chat_data, messages, report)
+                finally:
+                    if on_done:
+                        on_done(chat_id)
+            except Exception as e:
+                # an executor would keep it in a future that nobody reads
+                self.logger.exception(f'Exception while broadcasting to chat {chat_id}', exc_info = e)
+            finally:
+                slots.release()
+
+        with ThreadPoolExecutor(self.workers, 'broadcast') as executor:
+            for chat_id, chat_data in chats:
+                slots.acquire()
+                executor.submit(task, chat_id, chat_data)
+
+        report.finished = time.monotonic()
+        self.logger.info(f'Broadcast finished: {report}')
+        if report.errors:
+            # one message for the whole broadcast, not one for each chat
+            self.global_bucket.acquire()
+            self.error(report.errors[0][1], f'Sending to {report.failed} chats failed in a broadcast',
+                errors = [f'{chat_id}: {e!r}' for chat_id, e in report.errors], message = messages[0])
+        return report
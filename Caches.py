@@ -0,0 +1,200 @@
+import logging
+import struct
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+
+
+class FileIdCache:
+    '''Maps image URLs to the telegram `file_id` of an uploaded copy.
+
+    Entries live in memory and in an LMDB sub-db, so they survive restarts.
+    When the sub-db grows over `max_entries`, the oldest entries are removed.'''
+
+    HEADER = struct.Struct('<d')
+
+    def __init__(self, env, db, max_entries = 1000):
+        self.env = env
+        self.db = db
+        self.max_entries = max_entries
+        self.memory = dict()
+        self.lock = Lock()
+        self.locks = dict()
+        self.logger = logging.getLogger('RSSBot.FileIdCache')
+
+    def get(self, url):
+        file_id = self.memory.get(url)
+        if file_id is None:
+            with self.env.begin(self.db) as txn:
+                value = txn.get(url.encode())
+            if value is not None:
+                file_id = value[self.HEADER.size:].decode()
+                with self.lock:
+                    self.memory[url] = file_id
+        return file_id
+
+    def put(self, url, file_id):
+        with self.lock:
+            self.memory[url] = file_id
+            if len(self.memory) > self.max_entries:
+                # drop the oldest half, LMDB still has them
+                for key in list(self.memory)[:len(self.memory)//2]:
+                    del self.memory[key]
+        with self.env.begin(self.db, write = True) as txn:
+            txn.put(url.encode(), self.HEADER.pack(time.time()) + file_id.encode())
+            entries = txn.stat(self.db)['entries']
+            if entries > self.max_entries:
+                self.evict(txn, entries - self.max_entries + self.max_entries//10)
+
+    def discard(self, url):
+        with self.lock:
+            self.memory.pop(url, None)
+        with self.env.begin(self.db, write = True) as txn:
+            txn.delete(url.encode())
+
+    def evict(self, txn, count):
+        oldest = sorted(
+            (self.HEADER.unpack_from(value)[0], key) for key, value in txn.cursor(self.db))
+        for _, key in oldest[:count]:
+            txn.delete(key, db = self.db)
+            with self.lock:
+                self.memory.pop(key.decode(), None)
+        self.logger.debug(f'Evicted {min(count, len(oldest))} file ids')
+
+    def lock_for(self, url):
+        'A lock that makes only one thread upload `url` at a time'
+        with self.lock:
+            lock = self.locks.get(url)
+            if lock is None:
+                lock = self.locks[url] = Lock()
+            if len(self.locks) > self.max_entries:
+                for key in list(self.locks)[:len(self.locks)//2]:
+                    if not self.locks[key].locked():
+                        del self.locks[key]
+            return lock
+
+
+class TTLCache:
+    '''A thread-safe LRU cache whose entries expire after `ttl` seconds.'''
+
+    def __init__(self, max_entries = 256, ttl = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default = None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.finished = 0
+        # seconds that the result is kept
+        self.fresh = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''Runs a call once for all callers that ask for the same key at the same time.
+
+    Callers that come while the call is running wait for it and get the same
+    result. A result is given to new callers for `fresh` seconds after it is
+    made (`fresh` of the caller that made the call, a caller with `fresh` 0
+    only joins a running call) and then it is dropped; errors are given only
+    to callers that were waiting.'''
+
+    def __init__(self, fresh = 30):
+        self.fresh = fresh
+        self.calls = dict()
+        self.lock = Lock()
+
+    def do(self, key, func, *args, fresh = None):
+        fresh = self.fresh if fresh is None else fresh
+        with self.lock:
+            self.expire()
+            call = self.calls.get(key)
+            leader = call is None or call.done.is_set() and time.monotonic() - call.finished >= fresh
+            if leader:
+                call = self.calls[key] = _Call()
+                call.fresh = fresh
+        if leader:
+            try:
+                call.result = func(*args)
+            except BaseException as e:
+                call.error = e
+            finally:
+                call.finished = time.monotonic()
+                if call.error is not None or call.fresh <= 0:
+                    self.forget(key, call)
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def forget(self, key, call = None):
+        'Drop the result of `key` (only if it is of `call`)'
+        with self.lock:
+            if call is None or self.calls.get(key) is call:
+                self.calls.pop(key, None)
+
+    def expire(self):
+        now = time.monotonic()
+        for key in [key for key, call in self.calls.items()
+                if call.done.is_set() and now - call.finished >= call.fresh]:
+            del self.calls[key]
+
+
+class SharedIterator:
+    '''An iterator that many threads can read from the start.
+
+    Items are taken from `iterable` once, when the first reader needs them,
+    so a reader that stops early does not make the rest of the items.'''
+
+    def __init__(self, iterable):
+        self.source = iter(iterable)
+        self.items = []
+        self.exhausted = False
+        self.lock = Lock()
+
+    def __iter__(self):
+        index = 0
+        while True:
+            if index < len(self.items):
+                yield self.items[index]
+                index += 1
+                continue
+            with self.lock:
+                if index < len(self.items):
+                    continue
+                if self.exhausted:
+                    return
+                try:
+                    self.items.append(next(self.source))
+                except StopIteration:
+                    self.exhausted = True
+                    return
@@ -0,0 +1,373 @@
+import io
+import itertools
+import logging
+import pickle
+import struct
+from threading import Event, Lock, Thread
+
+# Chat records in `chats_db`, version 1:
+#   version (B), chat id (q), type (B), members count (i) and length (H) of
+#   title, username, first_name and last_name, then these strings in utf-8
+VERSION = 1
+HEADER = struct.Struct('<BqBiHHHH')
+TYPES = ('private', 'group', 'supergroup', 'channel')
+UNKNOWN_TYPE = 255
+STRING_FIELDS = ('title', 'username', 'first_name', 'last_name')
+# first byte of a pickle (protocol 2 and later)
+PICKLE_MARK = b'\x80'
+
+
+class _DataUnpickler(pickle.Unpickler):
+    'Old records are plain dicts, they never need a class'
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f'chat record needs {module}.{name}')
+
+
+def encode(data: dict) -> bytes:
+    'Pack fields of a chat that bot uses'
+    chat_type = data.get('type')
+    strings = [(data.get(field) or '').encode()[:0xFFFF] for field in STRING_FIELDS]
+    return HEADER.pack(
+        VERSION,
+        int(data['id']),
+        TYPES.index(chat_type) if chat_type in TYPES else UNKNOWN_TYPE,
+        int(data.get('members-count') or 0),
+        *map(len, strings)) + b''.join(strings)
+
+
+def decode(value: bytes) -> dict:
+    'A chat as a dict like `chat.to_dict()` with `members-count`'
+    if value[:1] == PICKLE_MARK:
+        return decode_legacy(value)
+    version, chat_id, chat_type, members, title, username, first_name, last_name = HEADER.unpack_from(value)
+    if version != VERSION:
+        raise ValueError(f'unknown chat record version {version}')
+    data = {'id': chat_id, 'members-count': members}
+    if chat_type != UNKNOWN_TYPE:
+        data['type'] = TYPES[chat_type]
+    # unrolled, this runs for every chat of a broadcast
+    offset = HEADER.size
+    if title:
+        data['title'] = value[offset:offset+title].decode()
+        offset += title
+    if username:
+        data['username'] = value[offset:offset+username].decode()
+        offset += username
+    if first_name:
+        data['first_name'] = value[offset:offset+first_name].decode()
+        offset += first_name
+    if last_name:
+        data['last_name'] = value[offset:offset+last_name].decode()
+    return data
+
+
+def decode_legacy(value: bytes) -> dict:
+    data = _DataUnpickler(io.BytesIO(value)).load()
+    if not isinstance(data, dict):
+        raise ValueError(f'chat data is not a dict: {type(data)}')
+    return data
+
+
+def migrate(env, db, batch = 1000):
+    '''Rewrite pickled records of `db` in place.
+
+    Returns `(migrated, removed)`, records that can not be read are removed.
+    Each write transaction has `batch` records at most, so the bot can be
+    migrated while it runs.'''
+    migrated = removed = 0
+    start = b''
+    done = False
+    while not done:
+        with env.begin(db, write = True) as txn:
+            cursor = txn.cursor()
+            go = cursor.set_range(start)
+            count = 0
+            while go and count < batch:
+                count += 1
+                key, value = cursor.item()
+                if value[:1] == PICKLE_MARK:
+                    try:
+                        data = decode_legacy(value)
+                        data.setdefault('id', int(key))
+                        cursor.put(key, encode(data))
+                        migrated += 1
+                    except Exception:
+                        # delete moves cursor to the next record
+                        go = cursor.delete()
+                        removed += 1
+                        continue
+                go = cursor.next()
+            done = not go
+            if go:
+                start = cursor.key()
+    return migrated, removed
+
+
+HEADER_FIELDS = {'id', 'type', 'members-count'}
+
+
+def project(value: bytes, fields) -> dict:
+    'Only `fields` of a record, the strings are not decoded if they are not needed'
+    if value[:1] != PICKLE_MARK and HEADER_FIELDS.issuperset(fields):
+        _, chat_id, chat_type, members, *_ = HEADER.unpack_from(value)
+        data = {'id': chat_id, 'type': TYPES[chat_type] if chat_type != UNKNOWN_TYPE else None, 'members-count': members}
+    else:
+        data = decode(value)
+    return {field: data.get(field) for field in fields}
+
+
+def scan(env, db, values = False, batch = 1000):
+    '''Yield `(key, value)` of all records in `db`, value is None without `values`.
+
+    Records are read from the cursor `batch` at a time, each batch in a short
+    read transaction, so a long broadcast does not keep a transaction open.'''
+    start = b''
+    while True:
+        with env.begin(db) as txn:
+            cursor = txn.cursor()
+            if not cursor.set_range(start):
+                return
+            if values:
+                items = list(itertools.islice(cursor.iternext(), batch + 1))
+            else:
+                items = [(key, None) for key in itertools.islice(cursor.iternext(values = False), batch + 1)]
+        yield from items[:batch]
+        if len(items) <= batch:
+            return
+        start = items[batch][0]
+
+
+def iterate(env, db, fields = (), batch = 1000):
+    '''Yield `(chat_id, data)` of all chats in `db`.
+
+    `data` has only `fields`; with no fields it is None and values are not
+    read at all.'''
+    if not fields:
+        for key, _ in scan(env, db, False, batch):
+            yield int(key), None
+        return
+    for key, value in scan(env, db, True, batch):
+        yield int(key), project(value, fields)
+
+
+# chat counts in `data_db`, kept by `ChatStore`
+STATS_KEY = b'chat-stats'
+
+
+def empty_stats():
+    return dict({'chats': 0, 'members': 0}, **{chat_type: 0 for chat_type in TYPES})
+
+
+def count(stats, value: bytes, sign = 1):
+    'Add (or remove with sign -1) a record to `stats`'
+    try:
+        data = project(value, ('type', 'members-count'))
+    except Exception:
+        # bad records are not counted
+        return
+    stats['chats'] += sign
+    stats['members'] += sign * (data['members-count'] or 0)
+    if data['type'] in stats:
+        stats[data['type']] += sign
+
+
+def read_stats(txn, stats_db):
+    value = txn.get(STATS_KEY, db = stats_db)
+    return None if value is None else pickle.loads(value)
+
+
+def reconcile(env, db, stats_db):
+    'Count all chats again and save the stats, returns them'
+    stats = empty_stats()
+    with env.begin(write = True) as txn:
+        for _, value in txn.cursor(db):
+            count(stats, value)
+        txn.put(STATS_KEY, pickle.dumps(stats), db = stats_db)
+    return stats
+
+
+class ChatStore:
+    '''All reads and writes of the chats sub-db.
+
+    Saves and deletes are queued and written together in one transaction
+    every `flush_interval` seconds, or as soon as `max_pending` chats are
+    queued, so a broadcast that finds thousands of blocked chats does not
+    commit them one by one. Reads see queued changes.
+
+    Number of chats, members and chats of each type are saved in `stats_db`
+    and updated in the same transaction as the chats.'''
+
+    def __init__(self, env, db, stats_db, flush_interval = 1, max_pending = 1000, on_error = None):
+        self.env = env
+        self.db = db
+        self.stats_db = stats_db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.on_error = on_error
+        # key -> encoded record, or None to delete
+        self.pending = dict()
+        self.lock = Lock()
+        # only one flush writes at a time, in order
+        self.flush_lock = Lock()
+        self.wake = Event()
+        self.closed = False
+        self.logger = logging.getLogger('RSSBot.ChatStore')
+        with env.begin() as txn:
+            missing = read_stats(txn, stats_db) is None
+        if missing:
+            # chats are saved by an older version
+            self.reconcile()
+        self.thread = Thread(target = self.run, name = 'chat-store', daemon = True)
+        self.thread.start()
+
+    @staticmethod
+    def key(chat_id):
+        return str(chat_id).encode()
+
+    def queue(self, key, value):
+        with self.lock:
+            self.pending[key] = value
+            full = len(self.pending) >= self.max_pending
+        if full:
+            self.wake.set()
+
+    def save(self, data: dict):
+        self.queue(self.key(data['id']), encode(data))
+
+    def delete(self, chat_id):
+        self.queue(self.key(chat_id), None)
+
+    def get(self, chat_id):
+        key = self.key(chat_id)
+        with self.lock:
+            if key in self.pending:
+                value = self.pending[key]
+                return None if value is None else decode(value)
+        with self.env.begin(self.db) as txn:
+            value = txn.get(key)
+        return None if value is None else decode(value)
+
+    def iterate(self, fields = (), batch = 1000):
+        'See `iterate`, queued changes are written first'
+        self.flush()
+        return iterate(self.env, self.db, fields, batch)
+
+    def items(self):
+        'Yield `(chat_id, data)` of all chats, bad records are deleted'
+        self.flush()
+        for key, value in scan(self.env, self.db, True):
+            try:
+                yield int(key), decode(value)
+            except Exception as e:
+                self.queue(key, None)
+                self.error(e, 'bad chat record', chat_id = key.decode())
+
+    def page(self, start = None, size = 10, backward = False):
+        '''One page of chats in order of their keys.
+
+        The page is `size` chats after chat `start` (or from the first chat),
+        or before it with `backward`. Returns `(chats, more)`, `more` is True
+        if there are chats after the page (before it, with `backward`).
+        Bad records are given as None.'''
+        self.flush()
+        start = None if start is None else self.key(start)
+        with self.env.begin(self.db) as txn:
+            cursor = txn.cursor()
+            if backward:
+                if start is not None and cursor.set_range(start):
+                    go = cursor.prev()
+                else:
+                    go = cursor.last()
+                step = cursor.prev
+            else:
+                if start is None:
+                    go = cursor.first()
+                else:
+                    go = cursor.set_range(start)
+                    if go and cursor.key() == start:
+                        go = cursor.next()
+                step = cursor.next
+            items = []
+            while go and len(items) <= size:
+                items.append(cursor.item())
+                go = step()
+        more = len(items) > size
+        items = items[:size]
+        if backward:
+            items.reverse()
+        chats = []
+        for key, value in items:
+            try:
+                chats.append((int(key), decode(value)))
+            except Exception:
+                chats.append((int(key), None))
+        return chats, more
+
+    def count(self):
+        self.flush()
+        with self.env.begin(self.db) as txn:
+            return txn.stat(self.db)['entries']
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, dict()
+            if not pending:
+                return 0
+            try:
+                with self.env.begin(write = True) as txn:
+                    stats = read_stats(txn, self.stats_db) or empty_stats()
+                    for key, value in pending.items():
+                        old = txn.get(key, db = self.db)
+                        if old is not None:
+                            count(stats, old, -1)
+                        if value is None:
+                            txn.delete(key, db = self.db)
+                        else:
+                            txn.put(key, value, db = self.db)
+                            count(stats, value)
+                    txn.put(STATS_KEY, pickle.dumps(stats), db = self.stats_db)
+            except Exception:
+                # nothing is written, the changes are written by the next flush;
+                # changes that are queued since then are newer
+                with self.lock:
+                    for key, value in pending.items():
+                        self.pending.setdefault(key, value)
+                raise
+            self.logger.debug(f'Wrote {len(pending)} chats')
+            return len(pending)
+
+    def stats(self):
+        'Number of chats, members and chats of each type'
+        self.flush()
+        with self.env.begin() as txn:
+            return read_stats(txn, self.stats_db) or empty_stats()
+
+    def reconcile(self):
+        'Rebuild stats with a full scan'
+        with self.flush_lock:
+            stats = reconcile(self.env, self.db, self.stats_db)
+        self.logger.info(f'Chat stats reconciled: {stats}')
+        return stats
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.error(e, 'Exception while writing chats')
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+
+    def error(self, exc, msg, report = True, **kwargs):
+        if self.on_error:
+            self.on_error(exc, msg, report, **kwargs)
+        else:
+            self.logger.exception(msg, exc_info=exc)
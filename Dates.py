@@ -0,0 +1,107 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+from dateutil.parser import parse as parse_fuzzy
+
+MONTHS = {name: i for i, name in enumerate(
+    ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1)}
+# zones that dateutil reads as UTC; other names (like EST) go to dateutil,
+# so dates of a source are not sometimes naive and sometimes aware
+UTC_NAMES = {'utc', 'gmt', 'z'}
+
+# RSS pubDate: Mon, 02 Jan 2006 15:04:05 +0000 (day name, seconds and zone are optional)
+RFC822 = re.compile(
+    r'\s*(?:[A-Za-z]{3,9},?\s*)?(\d{1,2})[\s-]+([A-Za-z]{3})[a-z]*\.?[\s-]+(\d{2}|\d{4})'
+    r'\s+(\d{1,2}):(\d{2})(?::(\d{2}))?\s*([+-]\d{2}:?\d{2}|[A-Za-z]{1,5})?\s*$')
+# Atom: 2006-01-02T15:04:05.999+00:00 (time, fraction and zone are optional)
+ISO8601 = re.compile(
+    r'\s*(\d{4})-(\d{2})-(\d{2})(?:[Tt ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d+))?)?)?'
+    r'\s*([Zz]|[+-]\d{2}(?::?\d{2})?)?\s*$')
+
+_zones = {0: timezone.utc}
+
+
+def offset_zone(text):
+    'A timezone of `+hhmm`, `+hh:mm` or `+hh`'
+    sign = -1 if text[0] == '-' else 1
+    digits = text[1:].replace(':', '')
+    minutes = sign * (int(digits[:2]) * 60 + int(digits[2:] or 0))
+    zone = _zones.get(minutes)
+    if zone is None:
+        zone = _zones[minutes] = timezone(timedelta(minutes = minutes))
+    return zone
+
+
+def parse_rfc822(text):
+    'Date of RFC 822 (and 2822), or None if `text` is not one'
+    match = RFC822.match(text)
+    if match is None:
+        return None
+    day, month, year, hour, minute, second, zone = match.groups()
+    month = MONTHS.get(month.lower())
+    if month is None:
+        return None
+    year = int(year)
+    if year < 100:
+        year += 2000 if year < 50 else 1900
+    if zone is None:
+        tzinfo = None
+    elif zone[0] in '+-':
+        tzinfo = offset_zone(zone)
+    elif zone.lower() in UTC_NAMES:
+        tzinfo = timezone.utc
+    else:
+        return None
+    try:
+        return datetime(year, month, int(day), int(hour), int(minute), int(second or 0), tzinfo = tzinfo)
+    except ValueError:
+        return None
+
+
+def parse_iso8601(text):
+    'Date of ISO 8601 (and RFC 3339), or None if `text` is not one'
+    match = ISO8601.match(text)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    if zone is None:
+        tzinfo = None
+    elif zone in 'Zz':
+        tzinfo = timezone.utc
+    else:
+        tzinfo = offset_zone(zone)
+    try:
+        return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+            int(fraction[:6].ljust(6, '0')) if fraction else 0, tzinfo = tzinfo)
+    except ValueError:
+        return None
+
+
+class DateParser:
+    '''Parses dates of feed items.
+
+    RSS (RFC 822) and Atom (ISO 8601) dates are parsed with a regex, the
+    format of the last date of each source is remembered and tried first.
+    Dates that are in neither format are parsed with dateutil.'''
+
+    FORMATS = (parse_rfc822, parse_iso8601)
+
+    def __init__(self):
+        # source name -> parser
+        self.formats = dict()
+
+    def parse(self, text, source = None):
+        'Raises ValueError if `text` is not a date'
+        learned = self.formats.get(source)
+        if learned is not None:
+            date = learned(text)
+            if date is not None:
+                return date
+        for parser in self.FORMATS:
+            if parser is learned:
+                continue
+            date = parser(text)
+            if date is not None:
+                self.formats[source] = parser
+                return date
+        return parse_fuzzy(text)
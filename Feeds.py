@@ -0,0 +1,684 @@
+import hashlib
+import html
+import io
+import json
+import re
+import struct
+import time
+from threading import Lock
+
+import bs4
+import soupsieve
+from bs4 import BeautifulSoup as Soup
+from lxml import etree
+
+
+class SelectorPlan:
+    '''Selectors of a source, compiled once.
+
+    Soupsieve compiles a selector string every time it is used with
+    `select`; a plan compiles all of them once and then extracts items with
+    the compiled selectors. Like `select`, selectors of items use prefixes
+    of the xml namespaces of the page (and `namespaces` of the configs), so
+    they are compiled once for each set of namespaces.'''
+
+    FIELDS = ('id', 'title', 'link', 'time')
+    MAX_COMPILED = 8
+
+    def __init__(self, configs: dict):
+        self.configs = configs
+        self.namespaces = configs.get('namespaces') or dict()
+        # namespaces of a page -> selectors of items compiled with them
+        self.compiled = dict()
+
+        # remove-elements and content/ skip conditions select in html content
+        remove = configs.get('remove-elements', configs['remove-elements-selector']) or []
+        if not isinstance(remove, str):
+            remove = ', '.join(remove)
+        self.remove = self.compile(remove, self.namespaces)
+
+        # skip-condition format: feed/{selector}, content/{selector}, title/{regex}, link/{regex}
+        self.skip_field = None
+        self.skip_condition = None
+        self.skip = lambda value: False
+        skip_condition = configs['feed-skip-condition']
+        if isinstance(skip_condition, str):
+            self.skip_field, self.skip_condition = skip_condition.split('/', 1)
+            if self.skip_field == 'content':
+                match = self.compile(self.skip_condition, self.namespaces).select_one
+                self.skip = lambda tag: match(tag) is not None
+            elif self.skip_field in ('title', 'link'):
+                match = re.compile(self.skip_condition).match
+                self.skip = lambda text: bool(match(text))
+
+    @staticmethod
+    def compile(selector, namespaces):
+        if not selector:
+            # selector could be None (null)
+            return None
+        return soupsieve.compile(selector, namespaces)
+
+    def selectors(self, tag):
+        'Selectors of items for the page of `tag`'
+        namespaces = dict(getattr(tag, '_namespaces', None) or {})
+        namespaces.update(self.namespaces)
+        key = tuple(sorted(namespaces.items()))
+        selectors = self.compiled.get(key)
+        if selectors is None:
+            configs = self.configs
+            selectors = {
+                'feeds': self.compile(configs['feeds-selector'], namespaces),
+                'fields': [
+                    (field, self.compile(configs[field+'-selector'], namespaces), configs[field+'-attribute'])
+                    for field in self.FIELDS],
+                'content': self.compile(configs['content-selector'], namespaces),
+                'skip': self.compile(self.skip_condition, namespaces) if self.skip_field == 'feed' else None,
+            }
+            if len(self.compiled) >= self.MAX_COMPILED:
+                self.compiled.clear()
+            self.compiled[key] = selectors
+        return selectors
+
+    def select(self, page):
+        return self.selectors(page)['feeds'].select(page)
+
+    @staticmethod
+    def get_content(tag):
+        if isinstance(tag, bs4.NavigableString):
+            return tag.string
+        else:
+            return ''.join([str(c) for c in tag.contents])
+
+    def extract(self, feed):
+        'Read a feed item, returns None if the item must be skipped'
+        selectors = self.selectors(feed)
+        if selectors['skip'] is not None and selectors['skip'].select_one(feed) is not None:
+            return None
+
+        item = dict()
+        for field, selector, attribute in selectors['fields']:
+            value = None
+            if selector:
+                tag = selector.select_one(feed)
+                if tag is None and field == 'id':
+                    # not all items have an id (guid)
+                    item[field] = None
+                    continue
+                value = str(tag.attrs[attribute]) if attribute else str(tag.text)
+                if self.skip_field == field and self.skip(value):
+                    return None
+            item[field] = value
+
+        content = None
+        if selectors['content']:
+            content = self.get_content(selectors['content'].select_one(feed))
+
+        return self.clean({
+            'id': item['id'],
+            'title': item['title'],
+            'link': item['link'],
+            'content': content,
+            'date': item['time']
+            })
+
+    def clean(self, item):
+        'Skip or remove elements of the content, returns None if the item must be skipped'
+        content = item['content']
+        # content is html text, a tree is made only to skip or remove elements
+        if content is not None and (self.skip_field == 'content' or self.remove):
+            content = item['content'] = Soup(content, features="lxml")
+            if self.skip_field == 'content' and self.skip(content):
+                return None
+            #Remove elements with selector
+            if self.remove:
+                for element in self.remove.select(content):
+                    element.extract()
+        return item
+
+    def filter(self, item):
+        'Skip condition and remove-elements for an item of a native extractor'
+        if self.skip_field in ('title', 'link') and self.skip(item[self.skip_field] or ''):
+            return None
+        return self.clean(item)
+
+
+# Native extractors read common formats with lxml (or json) without css
+# selectors. Items are dicts like `SelectorPlan.extract` gives; a field is
+# the same text that the default selectors of the format would give.
+
+RDF_ABOUT = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about'
+ROOT_TAG = re.compile(rb'<(?![?!])(?:[\w.-]+:)?([\w.-]+)')
+XML_FORMATS = {'rss': 'rss', 'RDF': 'rss', 'feed': 'atom'}
+
+
+def detect_format(head: bytes):
+    'Format of a page from its first bytes: rss, atom, json or None'
+    head = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+    if head[:1] == b'{':
+        return 'json'
+    match = ROOT_TAG.search(head)
+    return XML_FORMATS.get(match[1].decode()) if match else None
+
+
+def xml_parser():
+    # like the xml parser of BeautifulSoup, broken feeds are read as far as possible
+    return etree.XMLParser(resolve_entities = False, no_network = True, huge_tree = True, recover = True)
+
+
+def children(element):
+    'Children of an element by their local names, the first one of each name'
+    plain = dict()
+    spaced = dict()
+    for child in element:
+        tag = child.tag
+        if not isinstance(tag, str):
+            # a comment
+            continue
+        if tag[0] == '{':
+            spaced.setdefault(tag[tag.index('}')+1:], child)
+        else:
+            plain.setdefault(tag, child)
+    # elements without a namespace come first, like <link> before <atom:link>
+    spaced.update(plain)
+    return spaced
+
+
+def text(element):
+    return None if element is None else ''.join(element.itertext())
+
+
+def inner(element):
+    'Content of an element as html text'
+    if element is None:
+        return None
+    return (element.text or '') + ''.join(etree.tostring(child, encoding = str) for child in element)
+
+
+def extract_rss(element):
+    'An item of RSS 2.0 (or 1.0)'
+    fields = children(element)
+    guid = fields.get('guid')
+    content = fields.get('description')
+    if content is None:
+        content = fields.get('encoded')
+    date = fields.get('pubDate')
+    if date is None:
+        date = fields.get('date')
+    return {
+        'id': text(guid) if guid is not None else element.get(RDF_ABOUT),
+        'title': text(fields.get('title')),
+        'link': text(fields.get('link')),
+        'content': inner(content),
+        'date': text(date)
+        }
+
+
+def extract_atom(element):
+    'An entry of Atom'
+    fields = children(element)
+    link = None
+    for child in element.iterfind('{*}link'):
+        if child.get('rel', 'alternate') == 'alternate':
+            link = child.get('href')
+            break
+    content = fields.get('content')
+    if content is None:
+        content = fields.get('summary')
+    date = fields.get('published')
+    if date is None:
+        date = fields.get('updated')
+    return {
+        'id': text(fields.get('id')),
+        'title': text(fields.get('title')),
+        'link': link,
+        'content': inner(content),
+        'date': text(date)
+        }
+
+
+def extract_json(item: dict):
+    'An item of JSON Feed'
+    content = item.get('content_html')
+    if content is None and (item.get('content_text') or item.get('summary')):
+        content = html.escape(item.get('content_text') or item.get('summary'), quote = False)
+    item_id = item.get('id')
+    return {
+        'id': None if item_id is None else str(item_id),
+        'title': item.get('title'),
+        'link': item.get('url') or item.get('external_url'),
+        'content': content,
+        'date': item.get('date_published') or item.get('date_modified')
+        }
+
+
+EXTRACTORS = {'rss': (extract_rss, 'item'), 'atom': (extract_atom, 'entry')}
+
+
+class Prepended:
+    'Bytes that are read from a response, then the rest of the response'
+
+    def __init__(self, head, rest):
+        self.head = head
+        self.rest = rest
+
+    def read(self, size = -1):
+        if self.head:
+            if size is None or size < 0:
+                data, self.head = self.head + self.rest.read(), b''
+                return data
+            data, self.head = self.head[:size], self.head[size:]
+            return data
+        return self.rest.read(size)
+
+    def close(self):
+        self.rest.close()
+
+
+class Cadence:
+    '''How often a source publishes, learned from dates of its items.
+
+    `gap` is the median time between the newest `samples` items. `ttl` (of
+    RSS, in seconds) and `max_age` (of Cache-Control) are hints of the feed
+    about how long it does not change.'''
+
+    TTL = re.compile(rb'<ttl>\s*(\d+)\s*</ttl>')
+    MAX_AGE = re.compile(r'max-age\s*=\s*(\d+)')
+
+    def __init__(self, samples = 20):
+        self.samples = samples
+        self.gap = None
+        self.newest = None
+        self.ttl = None
+        self.max_age = None
+
+    def learn(self, stamps):
+        'Learn from timestamps of items in the feed'
+        stamps = sorted(set(stamps), reverse = True)[:self.samples]
+        if not stamps:
+            return
+        self.newest = max(self.newest or stamps[0], stamps[0])
+        if len(stamps) > 1:
+            gaps = sorted(a - b for a, b in zip(stamps, stamps[1:]))
+            self.gap = gaps[len(gaps)//2]
+
+    def read_ttl(self, page):
+        if isinstance(page, str):
+            page = page.encode('utf-8')
+        match = self.TTL.search(page)
+        self.set_ttl(match and match[1].decode())
+
+    def set_ttl(self, minutes):
+        minutes = (minutes or '').strip()
+        self.ttl = int(minutes) * 60 if minutes.isdigit() else None
+
+    def read_cache_control(self, value):
+        match = self.MAX_AGE.search(value or '')
+        self.max_age = int(match[1]) if match and 'no-cache' not in value and 'no-store' not in value else None
+
+    def interval(self, now, min_interval, max_interval, factor = 0.5):
+        '''Seconds between two checks, or None if nothing is learned yet.
+
+        A source is checked `1/factor` times for each post. When the source
+        is quiet for longer than its gap, the interval grows with the quiet
+        time. The feed is not checked more often than its hints say.'''
+        if self.newest is None:
+            return None
+        quiet = max(0, now - self.newest)
+        gap = quiet if self.gap is None else max(self.gap, quiet / 2)
+        interval = min(max(gap * factor, min_interval), max_interval)
+        hint = max(self.ttl or 0, self.max_age or 0)
+        return max(interval, min(hint, max_interval))
+
+    def state(self):
+        return (self.gap, self.newest, self.ttl, self.max_age)
+
+    def load(self, state):
+        self.gap, self.newest, self.ttl, self.max_age = state
+
+
+class SourceUnavailable(Exception):
+    'The circuit breaker of a source is open'
+
+
+class CircuitBreaker:
+    '''Failures of downloads of a source.
+
+    Closed: downloads are allowed, a failure is retried after `delay`
+    seconds, doubled for each failure. After `failures` failures in a row the
+    breaker opens: downloads are not tried for `reset` seconds. Then it is
+    half-open and one download is tried (a probe); if the probe fails the
+    breaker opens again for twice as long (up to `max_reset`), if it works
+    the breaker is closed.'''
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failures = 3, reset = 60, max_reset = 3600, delay = 3):
+        self.max_failures = failures
+        self.base_reset = reset
+        self.max_reset = max_reset
+        self.delay = delay
+        self.state = self.CLOSED
+        self.failures = 0
+        self.reset = reset
+        self.opened_until = 0
+        self.probing = False
+        self.last_error = None
+        self.lock = Lock()
+
+    def allow(self):
+        'True if a download can be tried now'
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() >= self.opened_until:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    return False
+                self.probing = True
+                return True
+            return self.state == self.CLOSED
+
+    def success(self):
+        'Returns True if this closed the breaker'
+        with self.lock:
+            closed = self.state != self.CLOSED
+            self.state = self.CLOSED
+            self.failures = 0
+            self.reset = self.base_reset
+            self.probing = False
+            self.last_error = None
+        return closed
+
+    def failure(self, error):
+        'Returns True if this opened a closed breaker, a failed probe opens it again'
+        with self.lock:
+            self.failures += 1
+            self.last_error = repr(error)
+            if self.state == self.HALF_OPEN:
+                self.reset = min(self.reset * 2, self.max_reset)
+            elif self.failures < self.max_failures:
+                return False
+            opened = self.state == self.CLOSED
+            self.state = self.OPEN
+            self.probing = False
+            self.opened_until = time.monotonic() + self.reset
+        return opened
+
+    def retry_in(self):
+        'Seconds until the next download should be tried, None if nothing failed'
+        with self.lock:
+            if self.state == self.OPEN:
+                return max(0, self.opened_until - time.monotonic())
+            if self.state == self.CLOSED and self.failures:
+                return self.delay * 2 ** (self.failures - 1)
+            return None
+
+    def info(self):
+        retry_in = self.retry_in()
+        with self.lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'retry-in': retry_in,
+                'last-error': self.last_error
+            }
+
+
+class FeedSource:
+    '''One feed that bot follows, with its own selectors and interval.
+
+    Data of a source (like `last-feed-date`) are saved in `data_db` under
+    `key(name)`. When `feed-configs` is a single object, keys have no
+    prefix so old databases keep working.'''
+
+    # An RSS 2.0 feed; a source only needs to set what is different
+    DEFAULTS = {
+        'feed-format': 'xml',
+        'feeds-selector': 'item',
+        'id-selector': 'guid',
+        'id-attribute': None,
+        'time-selector': 'pubDate',
+        'time-attribute': None,
+        'link-selector': 'link',
+        'link-attribute': None,
+        'title-selector': 'title',
+        'title-attribute': None,
+        'content-selector': 'description',
+        'feed-skip-condition': None,
+        'remove-elements-selector': None,
+        'interval': None,
+        'streaming': False
+    }
+    NATIVE_FORMATS = ('rss', 'atom', 'json')
+
+    def __init__(self, configs: dict, prefix = None):
+        self.configs = dict(self.DEFAULTS)
+        self.configs.update(configs)
+        self.url = self.configs['source']
+        self.name = self.configs.get('name', self.url)
+        self.prefix = self.name+'/' if prefix is None else prefix
+        # seconds, None means the global interval
+        self.interval = self.configs['interval']
+        # (etag, last-modified) of the last download
+        self.validators = None
+        self.cadence = Cadence()
+        self.breaker = CircuitBreaker()
+
+        # rss, atom and json are read by native extractors; with auto the
+        # format is found from the page if the source uses the default
+        # selectors, other formats (xml, html, ...) use selectors
+        self.format = self.configs['feed-format']
+        skip_condition = self.configs['feed-skip-condition']
+        skip_feed = isinstance(skip_condition, str) and skip_condition.startswith('feed/')
+        if self.format in self.NATIVE_FORMATS and skip_feed:
+            raise ValueError(f'{self.name}: feed/ skip conditions need selectors, use feed-format xml')
+        default_selectors = not self.configs.get('namespaces') and all(
+            self.configs[key] == value for key, value in self.DEFAULTS.items()
+            if key.endswith(('-selector', '-attribute')) and key != 'remove-elements-selector')
+        self.native = self.format in self.NATIVE_FORMATS or self.format == 'auto' and default_selectors and not skip_feed
+        # features of BeautifulSoup for selectors
+        self.soup_format = 'xml' if self.format in self.NATIVE_FORMATS + ('auto',) else self.format
+
+        self.streaming = self.configs['streaming']
+        if self.streaming:
+            if self.format == 'json' or self.soup_format != 'xml':
+                raise ValueError(f'{self.name}: streaming is only available for xml feeds')
+            if not re.fullmatch(r'[\w.-]+', self.configs['feeds-selector']):
+                raise ValueError(f'{self.name}: feeds-selector must be a tag name for streaming')
+
+        self.plan = SelectorPlan(self.configs)
+
+    @classmethod
+    def from_configs(cls, feed_configs):
+        'Create sources from `feed-configs`, a single source or a list of them'
+        if isinstance(feed_configs, dict):
+            return [cls(feed_configs, prefix = '')]
+        sources = [cls(configs) for configs in feed_configs]
+        names = [source.name for source in sources]
+        if len(set(names)) != len(names):
+            raise ValueError('feed sources must have unique names')
+        return sources
+
+    def key(self, name):
+        return self.prefix + name
+
+    def get_feeds(self, client, etag = None, last_modified = None):
+        '''Download the feed page with `client` (an `HttpClient`).
+
+        Returns `(page, (etag, last_modified))`, page is None if the server
+        says the feed has not changed since `etag` and `last_modified`. Page
+        is bytes, or for streaming sources the response itself, so items are
+        parsed while the page is downloaded.'''
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        response = client.request(self.url, headers)
+        if response.status == 304:
+            response.read()
+            return None, (etag, last_modified)
+        validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        self.cadence.read_cache_control(response.headers.get('Cache-Control'))
+        if self.streaming:
+            return response, validators
+        with response:
+            return response.read(), validators
+
+    def parse(self, page):
+        'Yield feed items of the page, newest first'
+        if self.native:
+            page_format = self.format
+            if page_format == 'auto':
+                page_format, page = self.detect(page)
+            if page_format == 'json':
+                return self.parse_json(page)
+            if page_format in EXTRACTORS:
+                return self.parse_native(page, *EXTRACTORS[page_format])
+            # not a known format, selectors are used
+        if self.streaming:
+            return self.iterparse(page)
+        self.cadence.read_ttl(page)
+        soup_page = Soup(page, self.soup_format)
+        return iter(self.plan.select(soup_page))
+
+    @staticmethod
+    def detect(page):
+        'Returns format of the page and the page, a response is read only as much as needed'
+        if isinstance(page, str):
+            page = page.encode('utf-8')
+        if isinstance(page, bytes):
+            return detect_format(page[:4096]), page
+        head = page.read(4096)
+        return detect_format(head), Prepended(head, page)
+
+    def parse_json(self, page):
+        if not isinstance(page, (str, bytes)):
+            with page:
+                page = page.read()
+        items = json.loads(page).get('items') or []
+        return (extract_json(item) for item in items if isinstance(item, dict))
+
+    def parse_native(self, page, extract, tag):
+        if self.streaming:
+            return (extract(element) for element in self.iterelements(page, tag))
+        if isinstance(page, str):
+            page = page.encode('utf-8')
+        self.cadence.read_ttl(page)
+        root = etree.fromstring(page, xml_parser())
+        if root is None:
+            raise ValueError(f'{self.name}: page is not xml')
+        return (extract(element) for element in root.iter('{*}'+tag))
+
+    def iterparse(self, page):
+        '''Parse items one at a time without building the whole page.
+
+        Every item is given as a small tree of its own and is removed from
+        the parser after that, so memory only depends on items that the
+        caller reads. Parsing stops when the caller stops reading. `page` is
+        bytes or a file-like object (a response that is still downloading).'''
+        for element in self.iterelements(page, self.configs['feeds-selector']):
+            yield Soup(etree.tostring(element, with_tail = False), 'xml').find(True)
+
+    def iterelements(self, page, tag):
+        'Elements of items of the page, an element is cleared when the next one is read'
+        if isinstance(page, str):
+            page = page.encode('utf-8')
+        if isinstance(page, bytes):
+            page = io.BytesIO(page)
+        # broken feeds are read as far as possible, like pages that are not streamed
+        parser = etree.iterparse(page, events = ('end',), tag = ('{*}'+tag, '{*}ttl'),
+            resolve_entities = False, no_network = True, huge_tree = True, recover = True)
+        try:
+            for _, element in parser:
+                if etree.QName(element).localname == 'ttl':
+                    self.cadence.set_ttl(element.text)
+                    continue
+                yield element
+                # free this item and items before it
+                element.clear(keep_tail = True)
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+        finally:
+            # a response that is not read to the end is closed
+            page.close()
+
+    def extract(self, feed):
+        'Read a feed item, returns None if the item must be skipped'
+        if isinstance(feed, dict):
+            # an item of a native extractor
+            item = self.plan.filter(feed)
+        else:
+            item = self.plan.extract(feed)
+        if item is not None:
+            item['source'] = self.name
+        return item
+
+
+class SeenIndex:
+    '''Items that bot has already seen, in an LMDB sub-db.
+
+    A key is 4 bytes of the hash of the source name and 8 bytes of the hash
+    of the item id (guid, link or title and date), so items of a source
+    are next to each other. Values are the last time the item was in its
+    feed; items that are not seen for `max_age` seconds are evicted.'''
+
+    TIME = struct.Struct('<d')
+
+    def __init__(self, env, db, max_age = 30*24*3600):
+        self.env = env
+        self.db = db
+        self.max_age = max_age
+
+    @staticmethod
+    def digest(text, size):
+        return hashlib.blake2b(text.encode(), digest_size = size).digest()
+
+    def source_prefix(self, source: FeedSource):
+        return self.digest(source.name, 4)
+
+    def key(self, source: FeedSource, item):
+        identity = item['id'] or item['link'] or f"{item['title']}\0{item['date']}"
+        return self.source_prefix(source) + self.digest(identity, 8)
+
+    def is_empty(self, source: FeedSource):
+        prefix = self.source_prefix(source)
+        with self.env.begin(self.db) as txn:
+            cursor = txn.cursor()
+            return not (cursor.set_range(prefix) and cursor.key().startswith(prefix))
+
+    def seen(self, key):
+        'Time that item was seen or None'
+        with self.env.begin(self.db) as txn:
+            value = txn.get(key)
+        return None if value is None else self.TIME.unpack(value)[0]
+
+    def add(self, keys, txn = None):
+        'Mark items as seen, in `txn` if it is given'
+        if txn is None:
+            with self.env.begin(self.db, write = True) as txn:
+                return self.add(keys, txn)
+        value = self.TIME.pack(time.time())
+        for key in keys:
+            txn.put(key, value, db = self.db)
+
+    def touch(self, key, seen_at):
+        'Keep items that are still in the feed'
+        if time.time() - seen_at > self.max_age / 2:
+            self.add([key])
+
+    def evict(self):
+        'Remove old items, returns number of removed items'
+        deadline = time.time() - self.max_age
+        removed = 0
+        with self.env.begin(self.db, write = True) as txn:
+            cursor = txn.cursor()
+            go = cursor.first()
+            while go:
+                if self.TIME.unpack(cursor.value())[0] < deadline:
+                    # delete moves cursor to the next item
+                    go = cursor.delete()
+                    removed += 1
+                else:
+                    go = cursor.next()
+        return removed
@@ -1,10 +1,9 @@
 import html
 import json
 import logging
-import pickle
 import random
 import string
-from threading import Timer
+import tempfile
 import BugReporter
 from datetime import datetime, timedelta
 
@@ -13,7 +12,7 @@ from telegram import (Chat, ChatMember, InlineKeyboardButton,
                       InlineKeyboardMarkup, InputMediaPhoto, ParseMode,
                       ReplyKeyboardMarkup, ReplyKeyboardRemove, Update)
 from telegram.bot import Bot
-from telegram.error import BadRequest, NetworkError, Unauthorized
+from telegram.error import BadRequest, NetworkError
 from telegram.ext import (BaseFilter, CallbackContext, CallbackQueryHandler,
                           ChatMemberHandler, CommandHandler,
                           ConversationHandler, Filters, MessageHandler,
@@ -144,67 +143,145 @@ def add_admin_handlers(server: BotHandler):
     @dispatcher_decorators.commandHandler
     @admin_auth
     def state(u: Update, c: CallbackContext):
-        members, chats = 0, 0
-        msg = u.message.reply_text('⏳ Please wait, counting members...')
-        with server.env.begin(server.chats_db) as txn:
-            chats = int(txn.stat()["entries"])
-            for key, value in txn.cursor():
-                v = pickle.loads(value)
-                members += v['members-count']
-        msg.edit_text(
-            f'👥chats:\t{chats}\n' +
-            f'👤members:\t{members}\n' +
-            f'🤵admins:\t{len(server.adminID)}'
+        stats = server.chats.stats()
+        u.message.reply_text(
+            f'👥chats:\t{stats["chats"]}\n' +
+            f'👤members:\t{stats["members"]}\n' +
+            f'🤵admins:\t{len(server.adminID)}\n\n' +
+            f'private:\t{stats["private"]}\n' +
+            f'groups:\t{stats["group"]}\n' +
+            f'supergroups:\t{stats["supergroup"]}\n' +
+            f'channels:\t{stats["channel"]}'
         )
 
+    @dispatcher_decorators.commandHandler
+    @admin_auth
+    def reconcile_state(u: Update, c: CallbackContext):
+        msg = u.message.reply_text('⏳ Please wait, counting chats again...')
+        stats = server.chats.reconcile()
+        msg.edit_text(f'✅ Done, {stats["chats"]} chats and {stats["members"]} members')
+
+    def unknown_query(u: Update, c: CallbackContext):
+        u.callback_query.answer("❌ ERROR\nUnknown answer", show_alert = True)
+
+    CHATS_PAGE_SIZE = 10
+
+    def chats_page(start = None, backward = False):
+        'Text and buttons of a page of /listchats'
+        chats, more = server.chats.page(start, CHATS_PAGE_SIZE, backward)
+        res = 'total: '+str(server.chats.stats()['chats'])+'\n'
+        for chat_id, chat in chats:
+            if chat is None:
+                res += html.escape(f'\n bad chat record; id:{chat_id}\n')
+                continue
+            if 'username' in chat:
+                chat['username'] = '@'+chat['username']
+            res += html.escape(json.dumps(chat,
+                                          indent=2, ensure_ascii=False))
+        buttons = []
+        if chats:
+            # a page that is reached with a button has chats on the other side
+            if more if backward else start is not None:
+                buttons.append(InlineKeyboardButton('⬅️ Previous', callback_data = f'chats-prev-{chats[0][0]}'))
+            if start is not None if backward else more:
+                buttons.append(InlineKeyboardButton('Next ➡️', callback_data = f'chats-next-{chats[-1][0]}'))
+        return res, InlineKeyboardMarkup([buttons, [InlineKeyboardButton('📄 Export all', callback_data = 'chats-export')]])
+
+    def export_chats(chat_id):
+        'Send all chats as a json-lines document, chats are written to a temporary file one by one'
+        with tempfile.TemporaryFile() as f:
+            for _, chat in server.chats.items():
+                f.write(json.dumps(chat, ensure_ascii=False).encode())
+                f.write(b'\n')
+            f.seek(0)
+            server.bot.send_document(chat_id, f, filename = 'chats.jsonl', caption = 'All chats')
+
     @dispatcher_decorators.commandHandler
     @admin_auth
     def listchats(u: Update, c: CallbackContext):
-        res = ''
-        with server.env.begin(server.chats_db) as txn:
-            res = 'total: '+str(txn.stat()["entries"])+'\n'
-            for key, value in txn.cursor():
-                chat = pickle.loads(value)
-                if type(chat) is not type(dict()):
-                    res += html.escape(
-                        f'\n bad data type; type:{type(chat)}, value:{chat}\n')
-                    continue
-                if 'username' in chat:
-                    chat['username'] = '@'+chat['username']
-                res += html.escape(json.dumps(chat,
-                                              indent=2, ensure_ascii=False))
-        u.message.reply_html(res)
+        if c.args == ['export']:
+            export_chats(u.effective_chat.id)
+            return
+        text, markup = chats_page()
+        u.message.reply_html(text, reply_markup = markup)
+
+    @dispatcher_decorators.addHandler
+    @HandlerDecorator(CallbackQueryHandler, pattern = '^chats-(next|prev)-')
+    @auth(server.adminID, unknown_query)
+    def listchats_page(u: Update, c: CallbackContext):
+        query = u.callback_query
+        _, direction, start = query.data.split('-', 2)
+        text, markup = chats_page(int(start), direction == 'prev')
+        query.answer()
+        query.edit_message_text(text, parse_mode = ParseMode.HTML, reply_markup = markup)
+
+    @dispatcher_decorators.addHandler
+    @HandlerDecorator(CallbackQueryHandler, pattern = '^chats-export$')
+    @auth(server.adminID, unknown_query)
+    def listchats_export(u: Update, c: CallbackContext):
+        u.callback_query.answer('⏳ Exporting...')
+        export_chats(u.effective_chat.id)
 
     @dispatcher_decorators.commandHandler
     @admin_auth
     def send_feed_toall(u: Update, c: CallbackContext):
-        server.send_feed(
-            server.render_feed(
-                next(server.read_feed()),
-                server.get_string('last-feed')
-            ),
-            server.iter_all_chats())
+        source = server.find_source(' '.join(c.args) if c.args else None)
+        if source is None:
+            u.message.reply_text('❌ Unknown source, sources are:\n'+'\n'.join(s.name for s in server.sources))
+            return
+        server.send_to_all(server.last_feed_messages(source))
 
     @dispatcher_decorators.commandHandler
     @admin_auth
     def set_interval(u: Update, c: CallbackContext):
         if len(c.args) == 1:
             if c.args[0].isdigit():
-                server.interval = int(c.args[0])
+                server.set_interval(int(c.args[0]))
                 u.message.reply_text(
                     '✅ Interval changed to '+str(server.interval))
-                server.check_thread.cancel()
-                if server.check_thread.is_alive():
-                    server.check_thread.join()
-                server.check_thread = Timer(server.interval, server.check_new_feed)
-                server.check_thread.start()
-                server.logger.info('Interval changed to '+str(server.interval))
-                server.set_data(
-                    'interval', server.interval, DB = server.data_db)
         else:
             u.message.reply_markdown_v2(
                 '❌ Bad command, use `/set_interval {new interval in seconds}`')
 
+    @dispatcher_decorators.commandHandler
+    @admin_auth
+    def schedule(u: Update, c: CallbackContext):
+        res = ''
+        sources = {server.check_job(source): source for source in server.sources}
+        for job in server.scheduler.info():
+            if job['running']:
+                next_run = 'running now'
+            else:
+                next_run = f'in {job["next-run"]:.0f}s'
+            if job['last-run'] is None:
+                last_run = 'never'
+            else:
+                last_run = (datetime.fromtimestamp(job['last-run']).strftime('%Y-%m-%d %H:%M:%S') +
+                    f' ({job["last-duration"]:.1f}s)')
+            res += (
+                f'<b>{html.escape(job["name"])}</b>\n'
+                f'every {job["interval"]:.0f}s, next run {next_run}\n'
+                f'last run: {last_run}, {job["runs"]} runs, {job["missed"]} missed\n')
+            if job['retry']:
+                res += 'retrying after a failed download\n'
+            source = sources.get(job['name'])
+            if source is not None:
+                breaker = source.breaker.info()
+                if breaker['failures']:
+                    res += f'source is {breaker["state"]}, {breaker["failures"]} failures'
+                    if breaker['retry-in'] is not None:
+                        res += f', next try in {breaker["retry-in"]:.0f}s'
+                    res += f'\nlast failure: <code>{html.escape(breaker["last-error"])}</code>\n'
+            if source is not None and source.interval is None and server.adaptive is not None:
+                cadence = source.cadence
+                gap = 'not learned yet' if cadence.gap is None else f'a post every {cadence.gap:.0f}s'
+                hint = max(cadence.ttl or 0, cadence.max_age or 0)
+                res += f'adaptive: {gap}' + (f', feed asks for {hint}s' if hint else '') + '\n'
+            if job['last-error']:
+                res += f'last error: <code>{html.escape(job["last-error"])}</code>\n'
+            res += '\n'
+        u.message.reply_html(res or 'No jobs')
+
     def add_keyboard(c: CallbackContext):
         'A function that create keyboard that needed in send_all conversation'
         keys = ['❌Cancel']
@@ -698,28 +775,15 @@ def add_admin_handlers(server: BotHandler):
             )
             return res
 
-        remove_ids = []
-        for chat_id, chat_data in server.iter_all_chats():
-            if chat_id != u.effective_chat.id:
-                try:
-                    send_message(chat_id, c)
-                except Unauthorized as e:
-                    server.log_bug(e, 'handled an exception while trying to send message to a chat. removing chat',
-                                   report=False, chat_id=chat_id, chat_data=chat_data)
-                    try:
-                        with server.env.begin(server.chats_db, write=True) as txn:
-                            txn.delete(str(chat_id).encode())
-                    except Exception as e2:
-                        server.log_bug(
-                            e2, 'exception while trying to remove chat')
-                        remove_ids.append(chat_id)
-                except Exception as e:
-                    server.log_bug(
-                        e, 'exception while trying to send message to a chat', chat_id=chat_id, chat_data=chat_data)
-
-        for chat_id in remove_ids:
-            with server.env.begin(server.chats_db, write=True) as txn:
-                txn.delete(str(chat_id).encode())
+        # messages are checked by sending them to the admin first
+        messages = []
+        for msg in c.user_data['messages']:
+            parse_mode = None if msg['parser'] is DEFAULT_NONE else msg['parser']
+            if msg['type'] == 'text':
+                messages.append({'type': 'text', 'text': msg['text'], 'parse_mode': parse_mode})
+            elif msg['type'] == 'photo':
+                messages.append({'type': 'image', 'src': msg['photo'].file_id, 'text': msg['caption'] or '', 'parse_mode': parse_mode})
+        server.send_to_all(messages, exclude = u.effective_chat.id)
 
         cleanup_last_preview(u.effective_chat.id, c)
         for key in ('messages', 'prev-dict', 'had-error', 'edit-cap', 'editing-prev-id'):
@@ -788,7 +852,7 @@ def add_users_handlers(server: BotHandler):
             u.message.reply_markdown_v2(
                 server.get_string('group-intro'))
 
-        server.set_data(key=str(chat.id), value=data)
+        server.chats.save(data)
 
     @dispatcher_decorators.commandHandler
     def last_feed(u: Update, c: CallbackContext):
@@ -796,12 +860,13 @@ def add_users_handlers(server: BotHandler):
             if c.user_data['time'] > datetime.now():
                 u.message.reply_text(server.get_string('time-limit-error'))
                 return
+        source = server.find_source(' '.join(c.args) if c.args else None)
+        if source is None:
+            u.message.reply_text(server.get_string('unknown-source'))
+            return
         wait_msg = u.message.reply_animation(open("wait animation.tgs", 'rb'))
         server.send_feed(
-            server.render_feed(
-                next(server.read_feed(0)),
-                server.get_string('last-feed')
-            ),
+            server.last_feed_messages(source),
             chats = [(u.effective_chat.id, c.chat_data)])
         wait_msg.delete()
         c.user_data['time'] = datetime.now() + timedelta(minutes = 2)      #The next request is available 2 minutes later
@@ -831,8 +896,7 @@ def add_other_handlers(server: BotHandler):
             status = u.my_chat_member.new_chat_member.status
             if status in (ChatMember.KICKED, ChatMember.LEFT, ChatMember.RESTRICTED):
                 logging.info('Bot had been kicked or blocked by a user')
-                with server.env.begin(server.chats_db, write = True) as txn:
-                    txn.delete(str(u.my_chat_member.chat.id).encode())
+                server.chats.delete(u.my_chat_member.chat.id)
 
     @dispatcher_decorators.messageHandler(Filters.status_update.new_chat_members)
     def onjoin(u: Update, c: CallbackContext):
@@ -840,7 +904,7 @@ def add_other_handlers(server: BotHandler):
             if member.username == server.bot.username:
                 data = u.effective_chat.to_dict()
                 data['members-count'] = u.effective_chat.get_members_count()-1
-                server.set_data(key = str(u.effective_chat.id), value = data)
+                server.chats.save(data)
                 server.bot.send_message(
                     server.ownerID,
                     '<i>Joined to a chat:</i>\n' +
@@ -855,7 +919,7 @@ def add_other_handlers(server: BotHandler):
     @dispatcher_decorators.messageHandler(Filters.status_update.left_chat_member)
     def onkick(u: Update, c: CallbackContext):
         if u.message.left_chat_member['username'] == server.bot.username:
-            data = server.get_data(str(u.effective_chat.id))
+            data = server.chats.get(u.effective_chat.id)
             if data:
                 server.bot.send_message(
                     server.ownerID,
@@ -864,8 +928,7 @@ def add_other_handlers(server: BotHandler):
                             data, indent = 2, ensure_ascii = False)),
                     ParseMode.HTML,
                     disable_notification = True)
-                with server.env.begin(server.chats_db, write = True) as txn:
-                    txn.delete(str(u.effective_chat.id).encode())
+                server.chats.delete(u.effective_chat.id)
 
     @dispatcher_decorators.errorHandler
     def error_handler(update: object, context: CallbackContext) -> None:
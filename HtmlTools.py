@@ -0,0 +1,250 @@
+import html
+import re
+from html.parser import HTMLParser
+
+import bs4
+
+# a tag or the text between two tags
+TOKENS = re.compile(r'<[^>]*>|[^<]+')
+VOID_TAGS = {'img', 'br', 'hr'}
+
+
+def tag_name(tag):
+    return re.match(r'</?\s*([\w-]*)', tag).group(1).lower()
+
+
+def summarize(content, max_length, read_more):
+    '''Cut html at a word so it fits in `max_length` with `read_more`.
+
+    Returns `(html, cut)`. The html is serialized once and read from
+    the start in one pass; tags that are open at the cut are closed.'''
+    content = str(content)
+    if len(content) <= max_length:
+        return content, False
+
+    read_more = html.escape(read_more, quote = False)
+    budget = max_length - len(read_more)
+    out = []
+    length = 0
+    # names of open tags and length of their closing tags
+    stack = []
+    closing = 0
+    for match in TOKENS.finditer(content):
+        token = match.group()
+        if token.startswith('<'):
+            name = tag_name(token)
+            if token.startswith('</'):
+                if stack and stack[-1] == name:
+                    stack.pop()
+                    closing -= len(name) + 3
+                    out.append(token)
+                    length += len(token)
+                continue
+            if token.startswith('<!') or token.startswith('<?'):
+                continue
+            extra = 0 if name in VOID_TAGS or token.endswith('/>') else len(name) + 3
+            if length + len(token) + closing + extra > budget:
+                break
+            out.append(token)
+            length += len(token)
+            if extra:
+                stack.append(name)
+                closing += extra
+        else:
+            room = budget - length - closing
+            if len(token) <= room:
+                out.append(token)
+                length += len(token)
+                continue
+            piece = token[:max(room, 0)]
+            wrap_index = piece.rfind(' ')
+            if wrap_index != -1:
+                piece = piece[:wrap_index]
+            # do not cut an entity like &amp;
+            amp = piece.rfind('&')
+            if amp != -1 and ';' not in piece[amp:]:
+                piece = piece[:amp]
+            out.append(piece)
+            break
+
+    out.extend(f'</{name}>' for name in reversed(stack))
+    out.append(read_more)
+    return ''.join(out), True
+
+
+# tags and attributes that telegram supports, this program will handle images it self
+TELEGRAM_TAGS = {'a', 'b', 'strong', 'i', 'em', 'code', 'pre', 's', 'strike', 'del', 'u'}
+TELEGRAM_ATTRS = {'a': 'href', 'img': 'src', 'pre': 'language'}
+# text of these tags is not a part of the post
+DROP_CONTENT_TAGS = {'script', 'style', 'head', 'title', 'template'}
+
+
+class Sanitizer:
+    '''Make telegram-safe html in a single pass.
+
+    Only `tags` and the attribute of `attrs` for each tag are kept, comments
+    and the text of scripts and styles are removed and images are collected
+    in `images` as `{'src', 'link'}` (link is the href of the image's `<a>`).
+    Events come from a BeautifulSoup tree (`feed_tree`) or from a string
+    (`feed_string`), open tags are always closed and empty tags are removed
+    from the output.
+
+    With `split_images` the output is cut at each image into `segments`:
+    `{'type': 'text', 'text'}` and `{'type': 'image', 'src', 'link'}` in
+    order of the post. Tags that are open at an image are closed before it
+    and opened again after it, so each text segment is valid html.'''
+
+    def __init__(self, tags = TELEGRAM_TAGS, attrs = TELEGRAM_ATTRS, images = True, split_images = False):
+        self.tags = set(tags)
+        if images:
+            self.tags.add('img')
+        self.attrs = attrs
+        self.split_images = split_images
+        self.out = []
+        self.images = []
+        self.segments = []
+        # open tags that are written to the output as [name, tag, index in out]
+        self.stack = []
+        # open `<a>` hrefs, for image links
+        self.links = []
+        self.drop = 0
+
+    def start(self, name, attrs):
+        if name in DROP_CONTENT_TAGS:
+            self.drop += 1
+            return
+        if self.drop or name not in self.tags:
+            return
+        attr = self.attrs.get(name)
+        value = attrs.get(attr) if attr else None
+        if name == 'img':
+            if value:
+                image = {'src': value, 'link': self.links[-1] if self.links else None}
+                self.images.append(image)
+                if self.split_images:
+                    self.cut()
+                    self.segments.append(dict(image, type = 'image'))
+                    self.reopen()
+                else:
+                    self.out.append(f'<img src="{html.escape(value)}"/>')
+            return
+        if name == 'a':
+            self.links.append(value)
+        if value is not None:
+            tag = f'<{name} {attr}="{html.escape(value)}">'
+        else:
+            tag = f'<{name}>'
+        self.out.append(tag)
+        self.stack.append([name, tag, len(self.out)-1])
+
+    def end(self, name):
+        if name in DROP_CONTENT_TAGS:
+            self.drop = max(self.drop - 1, 0)
+            return
+        if self.drop or not any(open_tag[0] == name for open_tag in self.stack):
+            return
+        # close tags that are not closed in the source too
+        while self.stack:
+            open_tag = self.stack.pop()
+            self.close(open_tag)
+            if open_tag[0] == 'a':
+                self.links.pop()
+            if open_tag[0] == name:
+                break
+
+    def close(self, open_tag):
+        name, tag, index = open_tag
+        if index == len(self.out) - 1:
+            # nothing is written in this tag
+            self.out.pop()
+        else:
+            self.out.append(f'</{name}>')
+
+    def cut(self):
+        'End the current text segment'
+        for open_tag in reversed(self.stack):
+            self.close(open_tag)
+        text = ''.join(self.out)
+        if text:
+            self.segments.append({'type': 'text', 'text': text})
+        self.out = []
+
+    def reopen(self):
+        for open_tag in self.stack:
+            self.out.append(open_tag[1])
+            open_tag[2] = len(self.out) - 1
+
+    def text(self, data):
+        if not self.drop:
+            self.out.append(html.escape(data, quote = False))
+
+    def feed_tree(self, node):
+        # walk without recursion, a tuple marks the end of a tag
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            if isinstance(node, str):
+                if type(node) in (bs4.NavigableString, bs4.CData):
+                    self.text(node)
+            elif isinstance(node, tuple):
+                self.end(node[0])
+            elif isinstance(node, bs4.Tag):
+                attrs = {k: ' '.join(v) if isinstance(v, list) else v for k, v in node.attrs.items()}
+                self.start(node.name, attrs)
+                todo.append((node.name,))
+                todo.extend(reversed(node.contents))
+        return self
+
+    def feed_string(self, text):
+        parser = _SanitizerParser(self)
+        parser.feed(text)
+        parser.close()
+        return self
+
+    def result(self):
+        while self.stack:
+            self.end(self.stack[-1][0])
+        return ''.join(self.out)
+
+    def get_segments(self):
+        self.cut()
+        self.stack = []
+        return self.segments
+
+
+class _SanitizerParser(HTMLParser):
+    def __init__(self, sanitizer):
+        super().__init__(convert_charrefs = True)
+        self.sanitizer = sanitizer
+
+    def handle_starttag(self, tag, attrs):
+        self.sanitizer.start(tag, dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.sanitizer.start(tag, dict(attrs))
+        self.sanitizer.end(tag)
+
+    def handle_endtag(self, tag):
+        self.sanitizer.end(tag)
+
+    def handle_data(self, data):
+        self.sanitizer.text(data)
+
+
+def feed(sanitizer, content):
+    if isinstance(content, bs4.PageElement):
+        sanitizer.feed_tree(content)
+    else:
+        sanitizer.feed_string(str(content))
+    return sanitizer
+
+
+def sanitize(content, images = True, tags = TELEGRAM_TAGS, attrs = TELEGRAM_ATTRS):
+    'Returns telegram-safe html of `content` (a string or a tree) and its images'
+    sanitizer = feed(Sanitizer(tags, attrs, images), content)
+    return sanitizer.result(), sanitizer.images
+
+
+def segment(content, tags = TELEGRAM_TAGS, attrs = TELEGRAM_ATTRS):
+    'Telegram-safe text and image segments of `content`, in one walk'
+    return feed(Sanitizer(tags, attrs, True, split_images = True), content).get_segments()
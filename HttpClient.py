@@ -0,0 +1,259 @@
+import http.client
+import logging
+import ssl
+import zlib
+from threading import Lock
+from urllib.parse import urljoin, urlsplit
+from urllib.request import getproxies, proxy_bypass
+
+
+class HttpError(Exception):
+    def __init__(self, url, status, reason, headers = None):
+        super().__init__(f'HTTP {status} {reason}: {url}')
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class Response:
+    '''A response whose body is read from the socket as it is used.
+
+    It is a file-like object (`read(size)`), so a parser can read it while it
+    is downloaded. The body is decompressed (gzip or deflate) on the fly and
+    can not be larger than `max_body` bytes. When the whole body is read,
+    the connection goes back to the pool of the client.'''
+
+    CHUNK = 64*1024
+
+    def __init__(self, client, key, conn, response, url, max_body):
+        self.client = client
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+        self.max_body = max_body
+        self.size = 0
+        self.buffer = b''
+        self.eof = False
+        self.closed = False
+        encoding = self.headers.get('Content-Encoding', '').lower()
+        self.decoder = None
+        if encoding == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decoder = zlib.decompressobj()
+        # deflate could be zlib wrapped or raw, servers send both
+        self.raw_deflate = encoding == 'deflate'
+        length = self.headers.get('Content-Length')
+        if length and length.isdigit() and not self.decoder and int(length) > max_body:
+            self.close()
+            raise BodyTooLarge(f'{url} is {length} bytes, more than {max_body}')
+
+    def decode(self, chunk):
+        if self.decoder is None:
+            return chunk
+        try:
+            data = self.decoder.decompress(chunk)
+        except zlib.error:
+            if not self.raw_deflate or self.size:
+                raise
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = self.decoder.decompress(chunk)
+        self.raw_deflate = False
+        return data
+
+    def fill(self):
+        'Read one chunk from the socket, returns False at the end of the body'
+        chunk = self.response.read1(self.CHUNK)
+        if not chunk:
+            if self.decoder is not None:
+                self.buffer += self.decoder.flush()
+            self.finish()
+            return False
+        data = self.decode(chunk)
+        self.size += len(data)
+        if self.size > self.max_body:
+            self.close()
+            raise BodyTooLarge(f'{self.url} is more than {self.max_body} bytes')
+        self.buffer += data
+        return True
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            while not self.eof and self.fill():
+                pass
+            data, self.buffer = self.buffer, b''
+            return data
+        while len(self.buffer) < size and not self.eof and self.fill():
+            pass
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def finish(self):
+        self.eof = True
+        if not self.closed:
+            self.closed = True
+            # the connection can send a new request only after this
+            self.response.close()
+            if self.response.will_close:
+                self.conn.close()
+            else:
+                self.client.release(self.key, self.conn)
+
+    def close(self):
+        'Close the response, a connection whose body is not read is not reused'
+        self.eof = True
+        if not self.closed:
+            self.closed = True
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HttpClient:
+    '''A small HTTP/1.1 client for feeds and images, shared by all threads.
+
+    Connections are kept alive and reused, up to `pool_size` idle
+    connections for each host. `connect_timeout` limits connecting (and the
+    TLS handshake), `read_timeout` limits each read of the socket. Proxies of
+    the environment (`http_proxy`, `https_proxy`, `no_proxy`) are used like
+    `urlopen` does.'''
+
+    REDIRECTS = (301, 302, 303, 307, 308)
+
+    def __init__(self, connect_timeout = 5, read_timeout = 30, max_body = 20*1024*1024,
+            pool_size = 4, max_redirects = 5, user_agent = 'Telegram-RSS-Bot'):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_body = max_body
+        self.pool_size = pool_size
+        self.max_redirects = max_redirects
+        self.user_agent = user_agent
+        self.context = ssl.create_default_context()
+        self.proxies = getproxies()
+        # (scheme, host, port) -> idle connections
+        self.pools = dict()
+        self.lock = Lock()
+        self.logger = logging.getLogger('RSSBot.HttpClient')
+
+    def proxy_for(self, scheme, host):
+        proxy = self.proxies.get(scheme)
+        if proxy is None or proxy_bypass(host):
+            return None
+        return urlsplit(proxy if '://' in proxy else 'http://'+proxy)
+
+    def connect(self, key):
+        scheme, host, port = key
+        proxy = self.proxy_for(scheme, host)
+        if scheme == 'https':
+            if proxy is None:
+                conn = http.client.HTTPSConnection(host, port, timeout = self.connect_timeout, context = self.context)
+            else:
+                conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or 80,
+                    timeout = self.connect_timeout, context = self.context)
+                conn.set_tunnel(host, port)
+        else:
+            if proxy is None:
+                conn = http.client.HTTPConnection(host, port, timeout = self.connect_timeout)
+            else:
+                conn = http.client.HTTPConnection(proxy.hostname, proxy.port or 80, timeout = self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def acquire(self, key):
+        'An idle connection to `key` and True, or a new one and False'
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool:
+                return pool.pop(), True
+        return self.connect(key), False
+
+    def release(self, key, conn):
+        with self.lock:
+            pool = self.pools.setdefault(key, [])
+            if len(pool) < self.pool_size:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = self.pools, dict()
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+    def send(self, key, method, target, headers):
+        conn, reused = self.acquire(key)
+        try:
+            conn.request(method, target, headers = headers)
+            return conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+        except BaseException:
+            conn.close()
+            raise
+        # the server has closed an idle connection, try once with a new one
+        conn = self.connect(key)
+        try:
+            conn.request(method, target, headers = headers)
+            return conn, conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+
+    def discard(self, key, conn, response):
+        'Skip a small body so the connection can be used again'
+        if response.length is not None and response.length <= 64*1024 and not response.will_close:
+            try:
+                response.read()
+                self.release(key, conn)
+                return
+            except OSError:
+                pass
+        conn.close()
+
+    def request(self, url, headers = None, method = 'GET', max_body = None) -> Response:
+        '''Send a request and return its response, redirects are followed.
+
+        Raises `HttpError` for 4xx and 5xx responses; other responses (like
+        304) are returned. The response must be read or closed.'''
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', self.user_agent)
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                raise ValueError(f'not an http url: {url}')
+            key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+            if parts.scheme == 'http' and self.proxy_for('http', parts.hostname):
+                # a proxy needs the whole url
+                target = url
+            else:
+                target = (parts.path or '/') + ('?'+parts.query if parts.query else '')
+            conn, response = self.send(key, method, target, headers)
+            location = response.headers.get('Location')
+            if response.status in self.REDIRECTS and location:
+                self.discard(key, conn, response)
+                url = urljoin(url, location)
+                if response.status == 303:
+                    method = 'GET'
+                continue
+            if response.status >= 400:
+                self.discard(key, conn, response)
+                raise HttpError(url, response.status, response.reason, response.headers)
+            return Response(self, key, conn, response, url, max_body or self.max_body)
+        raise HttpError(url, response.status, 'too many redirects', response.headers)
@@ -0,0 +1,139 @@
+import json
+import logging
+import struct
+import time
+from threading import Lock
+
+from telegram import InlineKeyboardButton
+
+
+class Outbox:
+    '''Broadcasts that are not finished yet, in an LMDB sub-db.
+
+    A job is the messages of one broadcast, saved under an 8 byte id. Chats
+    that are done are saved under the job id and the chat id, so a broadcast
+    that is stopped by a restart can be resumed without sending to them
+    again. These checkpoints are written in batches (every `checkpoint_batch`
+    chats or `checkpoint_interval` seconds); if the bot stops before a batch
+    is written, those chats get the messages again (at-least-once).'''
+
+    JOB_ID = struct.Struct('>Q')
+    SEPARATOR = b'/'
+
+    def __init__(self, env, db, checkpoint_interval = 1, checkpoint_batch = 100):
+        self.env = env
+        self.db = db
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_batch = checkpoint_batch
+        self.checkpoints = []
+        self.last_checkpoint = time.monotonic()
+        self.lock = Lock()
+        self.logger = logging.getLogger('RSSBot.Outbox')
+
+    @staticmethod
+    def encode_messages(messages):
+        return json.dumps([
+            dict(msg, markup = [[button.to_dict() for button in row] for row in msg.get('markup') or []])
+            for msg in messages]).encode()
+
+    @staticmethod
+    def decode_messages(value):
+        messages = json.loads(value)
+        for msg in messages:
+            msg['markup'] = [[InlineKeyboardButton.de_json(button, None) for button in row] for row in msg['markup']]
+        return messages
+
+    def prefix(self, job_id):
+        return self.JOB_ID.pack(job_id) + self.SEPARATOR
+
+    def add(self, messages, on_add = None) -> int:
+        '''Save a new job, returns its id.
+
+        `on_add(txn)` is called in the same transaction, so what it writes is
+        saved only with the job.'''
+        job_id = time.time_ns()
+        with self.env.begin(self.db, write = True) as txn:
+            while not txn.put(self.JOB_ID.pack(job_id), self.encode_messages(messages), overwrite = False):
+                job_id += 1
+            if on_add is not None:
+                on_add(txn)
+        return job_id
+
+    def jobs(self):
+        'Yield `(job_id, messages)` of unfinished jobs, oldest first'
+        with self.env.begin(self.db) as txn:
+            cursor = txn.cursor()
+            go = cursor.first()
+            while go:
+                key = cursor.key()
+                job_id, = self.JOB_ID.unpack_from(key)
+                if len(key) == self.JOB_ID.size:
+                    yield job_id, self.decode_messages(cursor.value())
+                # skip checkpoints of this job
+                go = cursor.set_range(self.JOB_ID.pack(job_id + 1))
+
+    def done_chats(self, job_id, batch = 1000):
+        'Keys of chats that are done, in order'
+        prefix = self.prefix(job_id)
+        start = prefix
+        while True:
+            with self.env.begin(self.db) as txn:
+                cursor = txn.cursor()
+                keys = []
+                go = cursor.set_range(start)
+                while go and len(keys) < batch:
+                    key = cursor.key()
+                    if not key.startswith(prefix):
+                        break
+                    keys.append(key)
+                    go = cursor.next()
+            for key in keys:
+                if key != start:
+                    yield key[len(prefix):]
+            if len(keys) < batch:
+                return
+            start = keys[-1]
+
+    def pending(self, job_id, chats):
+        '''Chats of `chats` that are not done yet.
+
+        `chats` must be in order of their keys (like `ChatStore.iterate`),
+        they are merged with checkpoints of the job without a lookup per chat.'''
+        done = self.done_chats(job_id)
+        next_done = next(done, None)
+        for chat_id, chat_data in chats:
+            key = str(chat_id).encode()
+            while next_done is not None and next_done < key:
+                next_done = next(done, None)
+            if next_done == key:
+                continue
+            yield chat_id, chat_data
+
+    def done(self, job_id, chat_id):
+        with self.lock:
+            self.checkpoints.append(self.prefix(job_id) + str(chat_id).encode())
+            due = (len(self.checkpoints) >= self.checkpoint_batch
+                or time.monotonic() - self.last_checkpoint > self.checkpoint_interval)
+        if due:
+            self.checkpoint()
+
+    def checkpoint(self):
+        with self.lock:
+            checkpoints, self.checkpoints = self.checkpoints, []
+            self.last_checkpoint = time.monotonic()
+            if not checkpoints:
+                return
+            with self.env.begin(self.db, write = True) as txn:
+                for key in checkpoints:
+                    txn.put(key, b'')
+
+    def finish(self, job_id):
+        'Remove a job and its checkpoints'
+        self.checkpoint()
+        prefix = self.prefix(job_id)
+        with self.env.begin(self.db, write = True) as txn:
+            txn.delete(self.JOB_ID.pack(job_id))
+            cursor = txn.cursor()
+            go = cursor.set_range(prefix)
+            while go and cursor.key().startswith(prefix):
+                go = cursor.delete()
@@ -0,0 +1,93 @@
+import html
+
+from telegram import InlineKeyboardButton
+
+import HtmlTools
+
+MAX_MSG_LEN = 4096
+MAX_CAP_LEN = 1024
+# strings that are used in messages of a post
+STRINGS = ('read-more', 'image-link', 'goto-post')
+# strings that are put before a post
+HEADERS = ('new-feed', 'last-feed')
+
+
+def add_header(messages, header: str):
+    'Messages of `render_body` with `header` before the post, `messages` are not changed'
+    if not messages:
+        return messages
+    return [dict(messages[0], text = header+'\n'+messages[0]['text'])] + messages[1:]
+
+
+def render_body(feed: dict, strings: dict, header_room = 0, tags = HtmlTools.TELEGRAM_TAGS, attrs = HtmlTools.TELEGRAM_ATTRS):
+    '''Messages of a post without a header.
+
+    Room for a header of `header_room` characters is left in the first
+    message, so the same messages are used with any header that is not
+    longer (see `add_header`). This function only uses its arguments, so it
+    can run in another process; content of the post could be a string or a
+    tree.'''
+    title = feed['title']
+    post_link = feed['link']
+    content = feed['content']
+    messages = [{
+        'type': 'text',
+        'text': '',
+        'markup': []
+    }]
+    # header and its new line
+    room = header_room + 1
+    if title:
+        title = f'<b>{html.escape(title, quote = False)}</b>'
+        if post_link:
+            title = f'<a href="{html.escape(post_link)}">{title}</a>'
+        messages[0]['text']+=title
+    if content:
+        segments = HtmlTools.segment(content, tags, attrs)
+        read_more = strings['read-more']
+        # no segment is rendered yet
+        first = True
+        # header and title are not followed by the text of post yet
+        separator = '\n'
+        for segment in segments:
+            last_message = messages[-1]
+            if segment['type'] == 'image':
+                if first and len(messages) == 1 and room + len(last_message['text']) <= MAX_CAP_LEN:
+                    # post starts with an image, header and title are its caption
+                    last_message['type'] = 'image'
+                    last_message['src'] = segment['src']
+                else:
+                    last_message = {
+                        'type': 'image',
+                        'src': segment['src'],
+                        'text': '',
+                        'markup': []
+                    }
+                    messages.append(last_message)
+                if segment['link']:
+                    last_message['markup'] = [[InlineKeyboardButton(strings['image-link'], segment['link'])]]
+                first = False
+                continue
+
+            if not segment['text'].strip():
+                continue
+            length = MAX_MSG_LEN if last_message['type'] == 'text' else MAX_CAP_LEN
+            length -= len(last_message['text']) + len(separator)
+            if last_message is messages[0]:
+                length -= room
+            text, overflow = HtmlTools.summarize(segment['text'], length, read_more)
+            last_message['text'] += separator + text
+            first = False
+            separator = ''
+            if overflow:
+                break
+
+        if post_link:
+            messages[-1]['markup'].append([InlineKeyboardButton(strings['goto-post'], post_link)])
+    return messages
+
+
+def portable(feed: dict) -> dict:
+    'A copy of `feed` that can be sent to another process'
+    content = feed['content']
+    return dict(feed, content = None if content is None else str(content))
@@ -0,0 +1,163 @@
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Thread
+
+
+class Job:
+    def __init__(self, name, func, interval, jitter = 0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        # run times without jitter, so jitter does not add up
+        self.scheduled = time.monotonic()
+        self.due = self.scheduled
+        # an extra run before `due`, it does not move the fixed rate
+        self.retry_at = None
+        self.running = False
+        # a running retry does not plan the next run
+        self.retrying = False
+        self.runs = 0
+        # runs that were missed and merged into one
+        self.missed = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+
+    def plan(self, now):
+        'Next run at a fixed rate from the last scheduled run, missed runs are skipped'
+        self.scheduled += self.interval
+        if self.scheduled < now:
+            missed = int((now - self.scheduled) // self.interval) + 1
+            self.missed += missed
+            self.scheduled += missed * self.interval
+        self.due = self.scheduled + random.uniform(0, self.jitter)
+
+    def next_run(self):
+        return self.due if self.retry_at is None else min(self.due, self.retry_at)
+
+    def info(self):
+        now = time.monotonic()
+        return {
+            'name': self.name,
+            'interval': self.interval,
+            'running': self.running,
+            'next-run': None if self.running else max(0, self.next_run() - now),
+            'retry': self.retry_at is not None,
+            'last-run': self.last_run,
+            'last-duration': self.last_duration,
+            'runs': self.runs,
+            'missed': self.missed,
+            'last-error': self.last_error
+        }
+
+
+class Scheduler:
+    '''Runs jobs at a fixed rate.
+
+    A job runs every `interval` seconds from its first run, a late run does
+    not move the next ones. A job never runs twice at the same time; if runs
+    are missed (a run took longer than the interval or the system slept)
+    they are merged into one. `jitter` adds a random delay up to that many
+    seconds to each run, so jobs with the same interval do not run at once.
+    Jobs run in a thread pool of `workers` threads.'''
+
+    def __init__(self, workers = 8, on_error = None):
+        self.jobs = dict()
+        self.cond = Condition()
+        self.executor = ThreadPoolExecutor(workers, 'scheduler')
+        self.on_error = on_error
+        self.stopped = False
+        self.thread = Thread(target = self.loop, name = 'scheduler', daemon = True)
+        self.logger = logging.getLogger('RSSBot.Scheduler')
+
+    def add(self, name, func, interval, jitter = 0, delay = 0):
+        'Run `func()` every `interval` seconds, first run is after `delay` seconds'
+        with self.cond:
+            job = self.jobs[name] = Job(name, func, interval, jitter)
+            job.scheduled = job.due = time.monotonic() + delay
+            self.cond.notify()
+        return job
+
+    def set_interval(self, name, interval):
+        'Change interval of a job, never waits for a running job'
+        with self.cond:
+            job = self.jobs[name]
+            if job.running and not job.retrying:
+                # the run plans its next run with the new interval
+                job.interval = interval
+                return
+            # `scheduled` is the next run, move it to one new interval after the last run
+            job.scheduled = job.scheduled - job.interval + interval
+            job.interval = interval
+            if not job.running:
+                job.due = max(job.scheduled, time.monotonic()) + random.uniform(0, job.jitter)
+            self.cond.notify()
+
+    def retry(self, name, delay):
+        '''Run a job again after `delay` seconds, unless it runs before that.
+
+        The retry does not move the fixed rate of the job.'''
+        with self.cond:
+            job = self.jobs.get(name)
+            if job is None:
+                return
+            retry_at = time.monotonic() + delay
+            job.retry_at = retry_at if job.retry_at is None else min(job.retry_at, retry_at)
+            self.cond.notify()
+
+    def info(self, name = None):
+        'Timings of a job or of all jobs'
+        with self.cond:
+            if name is not None:
+                return self.jobs[name].info()
+            return [job.info() for job in self.jobs.values()]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, wait = True):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.executor.shutdown(wait)
+
+    def loop(self):
+        with self.cond:
+            while not self.stopped:
+                now = time.monotonic()
+                waiting = [job for job in self.jobs.values() if not job.running]
+                due = [job for job in waiting if job.next_run() <= now]
+                for job in due:
+                    job.running = True
+                    job.retrying = job.due > now
+                    job.retry_at = None
+                    self.executor.submit(self.run, job)
+                if not due:
+                    timeout = min((job.next_run() for job in waiting), default = now + 3600) - now
+                    self.cond.wait(timeout)
+
+    def run(self, job: Job):
+        start = time.monotonic()
+        job.last_run = time.time()
+        error = None
+        try:
+            job.func()
+        except Exception as e:
+            error = e
+            if self.on_error:
+                self.on_error(e, f'Exception in scheduled job {job.name}')
+            else:
+                self.logger.exception(f'Exception in scheduled job {job.name}')
+        with self.cond:
+            job.running = False
+            job.runs += 1
+            job.last_duration = time.monotonic() - start
+            job.last_error = None if error is None else repr(error)
+            if not job.retrying:
+                job.plan(time.monotonic())
+            self.cond.notify()
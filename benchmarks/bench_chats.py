@@ -0,0 +1,83 @@
+'''Reading all chat records from LMDB, pickled (before Chats) and packed
+with Chats.encode.
+
+With no fields Chats.iterate reads keys only, as broadcasts do.
+
+    python benchmarks/bench_chats.py [chats]
+'''
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lmdb
+import Chats
+
+
+def make_chat(i):
+    'Like `chat.to_dict()` with members-count, as /start saves it'
+    if i % 10:
+        return {'id': 100000 + i, 'type': 'private', 'username': f'user{i}', 'first_name': 'First',
+            'last_name': 'Last', 'is_bot': False, 'language_code': 'en', 'members-count': 1}
+    return {'id': -1000000 - i, 'type': 'supergroup', 'title': f'Group number {i}',
+        'username': f'group{i}', 'members-count': 250}
+
+
+def fill(env, db, chats, encode):
+    with env.begin(db, write = True) as txn:
+        for i in range(chats):
+            chat = make_chat(i)
+            txn.put(str(chat['id']).encode(), encode(chat))
+
+
+def iterate(env, db, read):
+    start = time.perf_counter()
+    members = 0
+    with env.begin(db) as txn:
+        for key, value in txn.cursor():
+            members += read(value)
+    return time.perf_counter() - start
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    with tempfile.TemporaryDirectory() as path:
+        env = lmdb.open(path, max_dbs = 2, map_size = 2**30)
+        legacy_db = env.open_db(b'legacy')
+        packed_db = env.open_db(b'packed')
+        fill(env, legacy_db, chats, pickle.dumps)
+        fill(env, packed_db, chats, Chats.encode)
+
+        cases = (
+            ('pickle', legacy_db, lambda value: pickle.loads(value)['members-count']),
+            ('Chats.decode', packed_db, lambda value: Chats.decode(value)['members-count']))
+        for name, db, read in cases:
+            with env.begin(db) as txn:
+                size = sum(len(value) for _, value in txn.cursor())
+            elapsed = min(iterate(env, db, read) for _ in range(5))
+            print(f'{name:>19}: {elapsed*1000:7.1f} ms for {chats} chats, '
+                f'{elapsed/chats*1e6:5.2f} us/chat, {size/chats:5.1f} bytes/chat')
+
+        for fields in ((), ('id', 'type')):
+            elapsed = min(timed(lambda: sum(1 for _ in Chats.iterate(env, packed_db, fields))) for _ in range(5))
+            name = 'Chats.iterate(' + ', '.join(fields) + ')'
+            print(f'{name:>19}: {elapsed*1000:7.1f} ms for {chats} chats, '
+                f'{elapsed/chats*1e6:5.2f} us/chat')
+
+        start = time.perf_counter()
+        migrated, removed = Chats.migrate(env, legacy_db)
+        print(f'migrate: {migrated} chats in {time.perf_counter()-start:.2f} s')
+        env.close()
+
+
+if __name__ == '__main__':
+    main()
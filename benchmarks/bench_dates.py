@@ -0,0 +1,82 @@
+'''Parsing dates of feed items with dateutil (before Dates) and with
+Dates.DateParser.
+
+The corpus is dates as they are found in real RSS and Atom feeds. Results
+of both parsers are compared, a date that is different is printed.
+
+    python benchmarks/bench_dates.py [rounds]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dateutil.parser import parse as parse_date
+from Dates import DateParser
+
+# (source, date), sources use one format like real feeds do
+CORPUS = [
+    ('wordpress', 'Mon, 02 Jan 2023 15:04:05 +0000'),
+    ('wordpress', 'Tue, 31 Oct 2023 08:00:00 +0000'),
+    ('wordpress', 'Wed, 1 Nov 2023 23:59:59 +0330'),
+    ('news', 'Thu, 16 Nov 2023 10:30:00 GMT'),
+    ('news', 'Fri, 17 Nov 2023 07:05:12 GMT'),
+    ('news', 'Sat, 18 Nov 2023 12:00:00 UTC'),
+    ('blogger', 'Sun, 19 Nov 2023 19:45:00 -0800'),
+    ('blogger', 'Mon, 20 Nov 2023 03:15:27 -0500'),
+    ('short', '21 Nov 2023 14:20:00 +0100'),
+    ('short', '22 Nov 2023 14:20 +0100'),
+    ('short', 'Thu, 23 Nov 23 09:00:00 +0000'),
+    ('long-names', 'Friday, 24 November 2023 16:00:00 +0000'),
+    ('long-names', 'Saturday, 25 November 2023 16:00:00 +0000'),
+    ('no-zone', 'Sun, 26 Nov 2023 11:11:11'),
+    ('atom', '2023-11-27T08:09:10Z'),
+    ('atom', '2023-11-28T08:09:10+00:00'),
+    ('atom', '2023-11-29T08:09:10.123Z'),
+    ('atom', '2023-11-30T08:09:10.123456+03:30'),
+    ('github', '2023-12-01T10:20:30-08:00'),
+    ('github', '2023-12-02T10:20:30-07:00'),
+    ('jekyll', '2023-12-03T00:00:00+01:00'),
+    ('jekyll', '2023-12-04 12:34:56 +0100'),
+    ('hugo', '2023-12-05T12:34:56+0000'),
+    ('date-only', '2023-12-06'),
+    ('local', '2023-12-07T18:00:00'),
+    # these are not RFC 822 or ISO 8601, dateutil parses them
+    ('us', 'Dec 08, 2023 3:45 PM'),
+    ('eastern', 'Sat, 09 Dec 2023 10:00:00 EST'),
+]
+
+
+def run(parse, corpus, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for source, text in corpus:
+            parse(text, source)
+    return (time.perf_counter() - start) / (rounds * len(corpus)) * 1e6
+
+
+def main():
+    import warnings
+    # dateutil warns about EST
+    warnings.simplefilter('ignore')
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    parser = DateParser()
+    different = 0
+    for source, text in CORPUS:
+        expected = parse_date(text)
+        got = parser.parse(text, source)
+        if got != expected or (got.tzinfo is None) != (expected.tzinfo is None):
+            different += 1
+            print(f'different: {text!r} dateutil {expected!r} DateParser {got!r}')
+    print(f'{len(CORPUS)} dates, {different} different')
+
+    fast = [(source, text) for source, text in CORPUS if source not in ('us', 'eastern')]
+    for name, corpus in (('all dates', CORPUS), ('RSS and Atom dates', fast)):
+        print(f'{name}:')
+        print(f'  dateutil:   {run(lambda text, source: parse_date(text), corpus, rounds):6.2f} us/date')
+        print(f'  DateParser: {run(parser.parse, corpus, rounds):6.2f} us/date')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+'''Items per second of FeedSource.parse and extract, with css selectors and
+with the native extractors, on the same RSS 2.0 and Atom feeds.
+
+Items of both paths are compared, an item that is different is printed.
+JSON Feed has no selector path, only the native extractor is measured.
+
+    python benchmarks/bench_formats.py [items]
+'''
+import json
+import os
+import sys
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Feeds import FeedSource
+
+NOW = datetime(2021, 1, 1, tzinfo=timezone.utc)
+BODY = '<p>Some <b>text</b> &amp; a <a href="http://example.com/?a=1&amp;b=2">link</a> <img src="http://example.com/a.png"/></p>'
+
+
+def make_rss(items):
+    return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>Bench</title>'
+        '<link>http://example.com/</link><ttl>60</ttl>' + ''.join(
+        f'<item><title>Post {i} &amp; more</title><link>http://example.com/{i}</link>'
+        f'<guid isPermaLink="false">post-{i}</guid>'
+        f'<pubDate>{format_datetime(NOW - timedelta(hours=i))}</pubDate>'
+        + (f'<description><![CDATA[{BODY}]]></description>' if i % 2 else f'<description>{escape(BODY)}</description>')
+        + '</item>'
+        for i in range(items)) + '</channel></rss>').encode()
+
+
+def make_atom(items):
+    return ('<?xml version="1.0" encoding="UTF-8"?><feed xmlns="http://www.w3.org/2005/Atom"><title>Bench</title>' + ''.join(
+        f'<entry><title>Post {i}</title><id>urn:post:{i}</id>'
+        f'<link rel="alternate" href="http://example.com/{i}"/>'
+        f'<published>{(NOW - timedelta(hours=i)).isoformat()}</published>'
+        f'<content type="html">{escape(BODY)}</content></entry>'
+        for i in range(items)) + '</feed>').encode()
+
+
+def make_json(items):
+    return json.dumps({'version': 'https://jsonfeed.org/version/1.1', 'title': 'Bench', 'items': [
+        {'id': f'post-{i}', 'title': f'Post {i}', 'url': f'http://example.com/{i}',
+            'date_published': (NOW - timedelta(hours=i)).isoformat(), 'content_html': BODY}
+        for i in range(items)]}).encode()
+
+
+FEEDS = [
+    ('RSS 2.0', make_rss, {'source': 'bench', 'feed-format': 'xml'}, {'source': 'bench', 'feed-format': 'rss'}),
+    ('Atom', make_atom,
+        {'source': 'bench', 'feed-format': 'xml', 'feeds-selector': 'entry', 'id-selector': 'id',
+            'time-selector': 'published', 'link-selector': 'link', 'link-attribute': 'href',
+            'content-selector': 'content'},
+        {'source': 'bench', 'feed-format': 'atom'}),
+    ('JSON Feed', make_json, None, {'source': 'bench', 'feed-format': 'json'}),
+]
+
+
+def read(source, page):
+    items = []
+    for feed in source.parse(page):
+        item = source.extract(feed)
+        item['content'] = str(item['content'])
+        items.append(item)
+    return items
+
+
+def items_per_second(source, page, items, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        read(source, page)
+    return items * rounds / (time.perf_counter() - start)
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rounds = max(1, 2000 // items)
+    for name, make, selector_configs, native_configs in FEEDS:
+        page = make(items)
+        native = FeedSource(native_configs)
+        print(f'{name}, {items} items:')
+        if selector_configs is not None:
+            selectors = FeedSource(selector_configs)
+            different = sum(a != b for a, b in zip(read(selectors, page), read(native, page)))
+            print(f'  {different} items are different')
+            for a, b in zip(read(selectors, page), read(native, page)):
+                if a != b:
+                    print(f'  selectors: {a}\n  native:    {b}')
+                    break
+            print(f'  selectors: {items_per_second(selectors, page, items, rounds):10.0f} items/s')
+        print(f'  native:    {items_per_second(native, page, items, rounds):10.0f} items/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''Cost of making a blog post telegram-safe, with the old purge (regex,
+reparse and a walk over all nodes) and HtmlTools.sanitize.
+
+    python benchmarks/bench_sanitize.py [posts]
+'''
+import os
+import re
+import sys
+import timeit
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup as Soup
+from bs4 import Comment
+import HtmlTools
+
+SUPPORTED_HTML_TAGS = '|'.join(('a','b','strong','i','em','code','pre','s','strike','del','u'))
+SUPPORTED_TAG_ATTRS = {'a':'href', 'img':'src', 'pre':'language'}
+
+
+def legacy_purge(html, images=True) -> Soup:
+    'BotHandler.purge before HtmlTools'
+    tags = SUPPORTED_HTML_TAGS
+    if images:
+        tags+='|img'
+    if not isinstance(html, str):
+        html = str(html)
+    pattern = r'</?(?!(?:%s)\b)\w+[^>]*/?>'%tags
+    purge = re.compile(pattern).sub
+    soup = Soup(purge('', html), 'html.parser')
+    comments = soup.findAll(text=lambda text:isinstance(text, Comment))
+    for c in comments:
+        c.extract()
+    for tag in soup.descendants:
+        if tag.name in SUPPORTED_TAG_ATTRS:
+            attr = SUPPORTED_TAG_ATTRS[tag.name]
+            if attr in tag.attrs:
+                tag.attrs = {attr: tag[attr]}
+        else:
+            tag.attrs = dict()
+    return soup
+
+
+def make_post(i):
+    'Something like a wordpress post'
+    paragraphs = []
+    for j in range(30):
+        paragraphs.append(
+            f'<p class="has-text-align-justify" style="line-height:1.8">Paragraph {j} of post {i}: '
+            '<strong>Lorem ipsum</strong> dolor sit amet, <a href="https://example.com/page?id=1&amp;x=2" '
+            'target="_blank" rel="noreferrer noopener">consectetur</a> adipiscing elit, '
+            '<span style="color:#cf2e2e" class="has-inline-color">sed do eiusmod</span> tempor '
+            '<em>incididunt</em> ut labore et dolore magna aliqua.</p>')
+        if j % 6 == 0:
+            paragraphs.append(
+                f'<figure class="wp-block-image size-large"><a href="https://example.com/full/{j}.jpg">'
+                f'<img loading="lazy" width="1024" height="576" src="https://example.com/{i}/{j}.jpg" '
+                'alt="" class="wp-image-1" srcset="https://example.com/a.jpg 1024w, https://example.com/b.jpg 300w" '
+                'sizes="(max-width: 1024px) 100vw, 1024px"/></a><figcaption>A caption</figcaption></figure>')
+        if j % 10 == 0:
+            paragraphs.append('<!-- wp:code --><pre class="wp-block-code"><code>print("hello")</code></pre><!-- /wp:code -->')
+    return '<div class="entry-content">' + ''.join(paragraphs) + '<script>track();</script></div>'
+
+
+def main():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    posts = [make_post(i) for i in range(count)]
+    trees = [Soup(post, 'lxml') for post in posts]
+    print(f'{count} posts, {sum(map(len, posts))//count//1024} KB each')
+
+    runs = (
+        ('legacy purge (string)', lambda: [str(legacy_purge(post)) for post in posts]),
+        ('sanitize (string)', lambda: [HtmlTools.sanitize(post) for post in posts]),
+        ('legacy purge (tree)', lambda: [str(legacy_purge(tree)) for tree in trees]),
+        ('sanitize (tree)', lambda: [HtmlTools.sanitize(tree) for tree in trees]),
+    )
+    for name, func in runs:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        print(f'{name:>22}: {best/count*1000:7.2f} ms/post')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''Per-item extraction cost of read_feed, with selector strings and with a
+compiled SelectorPlan.
+
+    python benchmarks/bench_selectors.py [items]
+'''
+import os
+import sys
+import timeit
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup as Soup
+from Feeds import FeedSource, SelectorPlan
+
+
+CONFIGS = dict(FeedSource.DEFAULTS, **{
+    'source': 'bench',
+    'feed-skip-condition': 'content/[name="skip"]',
+    'remove-elements-selector': '.skip'
+})
+
+
+def make_feed(items):
+    now = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    body = escape('<p>Some <b>text</b> <span class="skip">hidden</span> <img src="http://example.com/a.png"/></p>')
+    return '<?xml version="1.0"?><rss version="2.0"><channel>' + ''.join(
+        f'<item><title>Post {i}</title><link>http://example.com/{i}</link>'
+        f'<pubDate>{format_datetime(now - timedelta(hours=i))}</pubDate>'
+        f'<description>{body}</description></item>'
+        for i in range(items)) + '</channel></rss>'
+
+
+def legacy_extract(feed, configs=CONFIGS):
+    'read_feed before selector plans'
+    skip_condition = configs['feed-skip-condition'].split('/', 1)[1]
+    title = str(feed.select_one(configs['title-selector']).text)
+    link = str(feed.select_one(configs['link-selector']).text)
+    time = str(feed.select_one(configs['time-selector']).text)
+    if not configs['content-selector']:
+        return title, link, None, time
+    tag = feed.select(configs['content-selector'])[0]
+    content = Soup(''.join([str(c) for c in tag.contents]), features="lxml")
+    if content.select(skip_condition):
+        return None
+    for e in content.select(configs['remove-elements-selector']):
+        e.extract()
+    return title, link, content, time
+
+
+def main():
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    page = Soup(make_feed(items), 'xml')
+    # without content, only selectors are measured
+    for title, configs in (('all fields', CONFIGS), ('without content', dict(CONFIGS, **{'content-selector': None}))):
+        plan = SelectorPlan(configs)
+
+        def legacy():
+            for feed in page.select(configs['feeds-selector']):
+                legacy_extract(feed, configs)
+
+        def planned():
+            for feed in plan.select(page):
+                plan.extract(feed)
+
+        print(title)
+        for name, func in (('selector strings', legacy), ('selector plan', planned)):
+            best = min(timeit.repeat(func, number=1, repeat=5))
+            print(f'  {name:>16}: {best/items*1e6:8.1f} us/item')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''Cost of cutting a long post to the telegram message limit, with the old
+summarize (it serialized every node again) and HtmlTools.summarize.
+
+    python benchmarks/bench_summarize.py [body size in KB]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup as Soup
+import HtmlTools
+
+MAX_MSG_LEN = 4096
+READ_MORE = 'read more ...'
+
+
+def legacy_summarize(soup, max_length, read_more):
+    'BotHandler.summarize before HtmlTools'
+    trim = len(read_more)
+    len_ = len(str(soup))
+    if len_>max_length:
+        trim += len_ - max_length
+        removed = 0
+        for element in reversed(list(soup.descendants)):
+            if (not element.name) and len(str(element))>trim-removed:
+                s = str(element)
+                wrap_index = s.rfind(' ',0 , trim-removed)
+                if wrap_index == -1:
+                    element.replace_with(s[:-trim+removed])
+                    removed = trim
+                else:
+                    element.replace_with(s[:wrap_index])
+                removed = trim
+            else:
+                element.replace_with('')
+                removed += len(str(element))
+            if removed >= trim:
+                break
+        soup.append(read_more)
+    return str(soup), len_>max_length
+
+
+def make_body(size):
+    paragraph = ('<b>Lorem ipsum</b> dolor sit amet, <a href="http://example.com">consectetur</a> '
+        'adipiscing elit, <i>sed do eiusmod</i> tempor incididunt ut labore et dolore magna aliqua. ')
+    body = ''
+    while len(body) < size:
+        body += paragraph * 3 + '\n'
+    return body
+
+
+def main():
+    sizes = [int(sys.argv[1])] if len(sys.argv) > 1 else [100, 200, 400]
+    for size in sizes:
+        body = make_body(size * 1024)
+        soup = Soup(body, 'html.parser')
+        start = time.perf_counter()
+        legacy, _ = legacy_summarize(soup, MAX_MSG_LEN, READ_MORE)
+        legacy_time = time.perf_counter() - start
+
+        soup = Soup(body, 'html.parser')
+        start = time.perf_counter()
+        new, _ = HtmlTools.summarize(soup, MAX_MSG_LEN, READ_MORE)
+        new_time = time.perf_counter() - start
+
+        print(f'{size:>4} KB: legacy {legacy_time*1000:9.1f} ms ({len(legacy)} chars), '
+            f'HtmlTools {new_time*1000:7.1f} ms ({len(new)} chars)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,81 +1,54 @@
 import argparse
+import hashlib
 import html
+import itertools
 from xml.sax.handler import feature_external_ges
-import bs4
 import commentjson
 import logging
 import os
 import pickle
-import re
 import sys
 
 from telegram.files.document import Document
 import BugReporter
+from Chats import ChatStore
+import Chats
+from Dates import DateParser
 import Handlers
+import HtmlTools
+import Rendering
+from Broadcaster import Broadcaster
+from Caches import FileIdCache, SharedIterator, SingleFlight, TTLCache
+from HttpClient import HttpClient
+from Feeds import CircuitBreaker, FeedSource, SeenIndex, SourceUnavailable
+from Outbox import Outbox
+from Scheduler import Scheduler
+from datetime import timedelta
+from concurrent.futures import Future, ProcessPoolExecutor
 import io
-from threading import Timer
-from urllib.request import urlopen
+import multiprocessing
+import queue
+from functools import partial
+from threading import Thread
 import lmdb
 from bs4 import BeautifulSoup as Soup
-from bs4 import Comment
-from dateutil.parser import parse as parse_date
-from telegram import (InlineKeyboardButton, InlineKeyboardMarkup,ParseMode)
-from telegram.error import Unauthorized
+from telegram import ParseMode
 from telegram.ext import Updater
 
 
 import time
-from functools import wraps
-
-
-def retry(tries=4, delay=3, backoff=2):
-    """Retry calling the decorated function using an exponential backoff.
-
-    http://www.saltycrane.com/blog/2009/11/trying-out-retry-decorator-python/
-    original from: http://wiki.python.org/moin/PythonDecoratorLibrary#Retry
-
-    :param ExceptionToCheck: the exception to check. may be a tuple of
-        exceptions to check
-    :type ExceptionToCheck: Exception or tuple
-    :param tries: number of times to try (not retry) before giving up
-    :type tries: int
-    :param delay: initial delay between retries in seconds
-    :type delay: int
-    :param backoff: backoff multiplier e.g. value of 2 will double the delay
-        each retry
-    :type backoff: int
-    :param logger: logger to use. If None, print
-    :type logger: logging.Logger instance
-    """
-    def deco_retry(f):
-
-        @wraps(f)
-        def f_retry(*args, **kwargs):
-            mtries, mdelay = tries, delay
-            while mtries > 1:
-                try:
-                    return f(*args, **kwargs)
-                except Exception as e:
-                    msg = "%s, Retrying in %d seconds..." % (str(e), mdelay)
-                    logging.warning(msg)
-                    time.sleep(mdelay)
-                    mtries -= 1
-                    mdelay *= backoff
-            return f(*args, **kwargs)
-
-        return f_retry  # true decorator
-
-    return deco_retry
 
 
 class BotHandler:
 
-    #All supported tags by telegram seprated by '|'
+    #All supported tags by telegram
     # this program will handle images it self
-    SUPPORTED_HTML_TAGS = '|'.join(('a','b','strong','i','em','code','pre','s','strike','del','u'))
-    SUPPORTED_TAG_ATTRS = {'a':'href', 'img':'src', 'pre':'language'}
-    MAX_MSG_LEN = 4096
-    MAX_CAP_LEN = 1024
+    SUPPORTED_HTML_TAGS = HtmlTools.TELEGRAM_TAGS
+    SUPPORTED_TAG_ATTRS = HtmlTools.TELEGRAM_ATTRS
+    MAX_MSG_LEN = Rendering.MAX_MSG_LEN
+    MAX_CAP_LEN = Rendering.MAX_CAP_LEN
+    # new posts that are rendered while the previous one is being sent
+    PIPELINE_DEPTH = 4
 
     def __init__(
         self,
@@ -84,11 +57,31 @@ class BotHandler:
         env,
         chats_db,
         data_db,
+        file_ids_db,
         strings: dict,
         bug_reporter = False,
         debug = False,
-        request_kwargs=None):
-        
+        request_kwargs=None,
+        broadcast_configs=None,
+        feed_workers=8,
+        seen_db=None,
+        seen_configs=None,
+        language='en-us',
+        render_configs=None,
+        feed_freshness=30,
+        chats_flush_interval=1,
+        outbox_db=None,
+        render_workers=2,
+        check_jitter=5,
+        adaptive_configs=None,
+        breaker_configs=None,
+        http_configs=None):
+
+        broadcast_configs = broadcast_configs or dict()
+        workers = broadcast_configs.get('workers', 32)
+        request_kwargs = dict(request_kwargs or {})
+        # every broadcast worker needs its own connection to telegram
+        request_kwargs.setdefault('con_pool_size', workers + 4)
         self.updater = Updater(Token, request_kwargs=request_kwargs)
         self.bot = self.updater.bot
         self.dispatcher = self.updater.dispatcher
@@ -96,19 +89,74 @@ class BotHandler:
         self.env = env
         self.chats_db = chats_db
         self.data_db = data_db
+        self.logger = logging.getLogger('RSSBot')
+        # every read and write of chats goes through this store
+        self.chats = ChatStore(env, chats_db, data_db, chats_flush_interval, on_error = self.log_bug)
+        # broadcasts to all chats, resumed after a restart
+        self.outbox = Outbox(env, outbox_db if outbox_db is not None else env.open_db(b'outbox'))
         self.adminID = self.get_data('adminID', [], DB = data_db)
         self.ownerID = self.get_data('ownerID', DB = data_db)
         self.admins_pendding = {}
         self.admin_token = []
         self.strings = strings
-        #`source` now is a property of `feed_config`
+        #`feed_configs` could be a list of sources
         self.feed_configs = feed_configs
-        self.source = feed_configs['source']
+        self.sources = FeedSource.from_configs(feed_configs)
+        # feeds and images are downloaded with this client, connections are kept alive
+        http_configs = http_configs or dict()
+        self.http = HttpClient(
+            http_configs.get('connect-timeout', 5),
+            http_configs.get('read-timeout', 30),
+            http_configs.get('max-body', 20*1024*1024),
+            http_configs.get('pool-size', 4))
+        breaker_configs = breaker_configs or dict()
+        for source in self.sources:
+            source.breaker = CircuitBreaker(
+                breaker_configs.get('failures', 3),
+                breaker_configs.get('reset', 60),
+                breaker_configs.get('max-reset', 3600),
+                breaker_configs.get('retry-delay', 3))
+        # checks of sources and other periodic jobs, one more thread for them
+        self.scheduler = Scheduler(feed_workers + 1, on_error = self.log_bug)
+        self.check_jitter = check_jitter
+        seen_configs = seen_configs or dict()
+        self.seen = SeenIndex(env, seen_db, seen_configs.get('max-age', 30) * 24*3600)
+        # seen items older than `last-feed-date` - lookback end a check
+        self.lookback = timedelta(days = seen_configs.get('lookback', 1))
+        self.language = language
+        render_configs = render_configs or dict()
+        # rendered messages of items, shared by /last_feed, /send_feed_toall and checks
+        self.rendered = TTLCache(render_configs.get('size', 256), render_configs.get('ttl', 3600))
+        # newest item of each source, so /last_feed does not download the feed again
+        self.latest = TTLCache(len(self.sources), render_configs.get('ttl', 3600))
+        # posts are rendered in other processes, 0 means in the check thread
+        self.render_pool = None
+        if render_workers:
+            self.render_pool = ProcessPoolExecutor(render_workers, multiprocessing.get_context('spawn'))
+        # concurrent reads of a source share one download and parse
+        self.fetches = SingleFlight(feed_freshness)
         self.interval = self.get_data('interval', 5*60, data_db)
-        self.__check = True
+        # dates of items, the format of each source is remembered
+        self.dates = DateParser()
+        # sources without their own interval learn it from their posts, None means off
+        self.adaptive = adaptive_configs
+        if self.adaptive is not None:
+            for source in self.sources:
+                state = self.get_data(source.key('cadence'), DB = data_db)
+                if state is not None:
+                    source.cadence.load(state)
         self.bug_reporter = bug_reporter if bug_reporter else None
         self.debug = False
-        self.logger = logging.getLogger('RSSBot')
+        self.broadcaster = Broadcaster(
+            self.bot,
+            workers = workers,
+            global_rate = broadcast_configs.get('global-rate', 30),
+            chat_rate = broadcast_configs.get('chat-rate', 1),
+            group_rate = broadcast_configs.get('group-rate', 20/60),
+            file_ids = FileIdCache(env, file_ids_db, broadcast_configs.get('file-id-cache-size', 1000)),
+            on_error = self.log_bug,
+            http = self.http,
+            max_image_size = http_configs.get('max-image', 10*1024*1024))
 
         if debug:
             Handlers.add_debuging_handlers(self)
@@ -119,30 +167,6 @@ class BotHandler:
         Handlers.add_other_handlers(self)
         Handlers.add_unknown_handlers(self)
 
-        # New configurations:
-        # - feed-format: specify feed fromat like xml or ...
-        # - feeds-list-selector: how to find list of all feeds
-        # - title-selector: how to find title
-        # - link-selector: how to get link of source
-        # - content-selector: how to get content
-        # - skip-condition: how to check skip condition
-        #   - format: feed/{selector}, content/{selector}, title/{regex}, link/{regex}, none
-
-        self.__skip = lambda feed: False
-        skip_condition = feed_configs.get('feed-skip-condition')
-        if isinstance(skip_condition, str):
-            self.__skip_field, skip_condition = skip_condition.split('/')
-            if self.__skip_field == 'feed':
-                self.__skip = lambda feed: bool(feed.select(skip_condition))
-            elif self.__skip_field == 'content':
-                self.__skip = lambda content: bool(content.select(skip_condition))
-            elif self.__skip_field == 'title':
-                match = re.compile(skip_condition).match
-                self.__skip = lambda title: bool(match(title))
-            elif self.__skip_field == 'link':
-                match = re.compile(skip_condition).match
-                self.__skip = lambda link: bool(match(link))
-
     def log_bug(self, exc:Exception, msg='', report = True, disable_notification = False,**args):
         info = BugReporter.exception(msg, exc, report = self.bug_reporter and report)
         self.logger.exception(msg, exc_info=exc)
@@ -159,7 +183,7 @@ class BotHandler:
             message+='\n\nExtra info:'
             msg+='\n\nExtra info'
             for key, value in args.items():
-                message+=f'\n<pre>{key} = {html.escape(commentjson.dumps(value, indent = 2, ensure_ascii = False))}</pre>'
+                message+=f'\n<pre>{key} = {html.escape(commentjson.dumps(value, indent = 2, ensure_ascii = False, default=str))}</pre>'
                 msg+=f'\n{key} = {commentjson.dumps(value, indent = 2, ensure_ascii = False, default=str)}'
         
         if len(message)<=self.MAX_MSG_LEN:
@@ -171,64 +195,46 @@ class BotHandler:
                 filename= '{file_name}_{line_no}.html'.format_map(info),
                 caption= 'log of an unhandled exception')
 
-    def __get_content (self, tag):
-        if isinstance(tag, bs4.NavigableString):
-            return tag.string
+    def purge(self, html, images=True) -> str:
+        return HtmlTools.sanitize(html, images, self.SUPPORTED_HTML_TAGS, self.SUPPORTED_TAG_ATTRS)[0]
+
+    def get_feeds(self, source: FeedSource, conditional = False):
+        if not source.breaker.allow():
+            raise SourceUnavailable(f'{source.name} is not available, next try in {source.breaker.retry_in():.0f}s')
+        self.logger.info(f'Getting feeds of {source.name}')
+        etag, last_modified = None, None
+        if conditional:
+            etag = self.get_data(source.key('etag'), DB = self.data_db)
+            last_modified = self.get_data(source.key('last-modified'), DB = self.data_db)
+        try:
+            page, validators = source.get_feeds(self.http, etag, last_modified)
+        except Exception as e:
+            if source.breaker.failure(e):
+                # the owner is told once, not on every failure of the source
+                try:
+                    self.log_bug(e, f'{source.name} failed {source.breaker.failures} times, it is not downloaded '
+                        f'for {source.breaker.reset:.0f} seconds', False, True, source = source.name)
+                except Exception as notice_error:
+                    self.logger.warning(f'Could not tell the owner that {source.name} is not available: {notice_error!r}')
+            raise
+        if source.breaker.success():
+            self.logger.info(f'{source.name} is available again')
+            try:
+                self.bot.send_message(chat_id = self.ownerID, text = f'{source.name} is available again',
+                    disable_notification = True)
+            except Exception as e:
+                # the download worked, a failed notice does not change that
+                self.logger.warning(f'Could not tell the owner that {source.name} is available: {e!r}')
+        if conditional:
+            source.validators = validators
+        if page is None:
+            self.logger.info(f'Feeds of {source.name} have not been modified')
         else:
-            return ''.join([str(c) for c in tag.contents])
-
-    def purge(self, html, images=True) -> Soup:
-        tags = self.SUPPORTED_HTML_TAGS
-        if images:
-            tags+='|img'
-        if not isinstance(html, str):
-            html = str(html)
-        pattern = r'</?(?!(?:%s)\b)\w+[^>]*/?>'%tags
-        purge = re.compile(pattern).sub      #This regex will purge any unsupported tag
-        soup = Soup(purge('', html), 'html.parser')
-        comments = soup.findAll(text=lambda text:isinstance(text, Comment))
-        for c in comments:
-            c.extract()
-        for tag in soup.descendants:
-            #Remove any unsupported attribute
-            if tag.name in self.SUPPORTED_TAG_ATTRS:
-                attr = self.SUPPORTED_TAG_ATTRS[tag.name]
-                if attr in tag.attrs:
-                    tag.attrs = {attr: tag[attr]}
-            else:
-                tag.attrs = dict()
-        return soup
-
-    @retry(10)
-    def get_feeds(self):
-        self.logger.info('Getting feeds')
-        with urlopen(self.feed_configs['source']) as f:
-            self.logger.info('Got feeds')
-            return f.read().decode('utf-8')
+            self.logger.info(f'Got feeds of {source.name}')
+        return page
 
     def summarize(self, soup:Soup, max_length, read_more):
-        trim = len(read_more)
-        len_ = len(str(soup))
-        if len_>max_length:
-            trim += len_ - max_length
-            removed = 0
-            for element in reversed(list(soup.descendants)):
-                if (not element.name) and len(str(element))>trim-removed:
-                    s = str(element)
-                    wrap_index = s.rfind(' ',0 , trim-removed)
-                    if wrap_index == -1:
-                        element.replace_with(s[:-trim+removed])
-                        removed = trim
-                    else:
-                        element.replace_with(s[:wrap_index])
-                    removed = trim
-                else:
-                    element.replace_with('')
-                    removed += len(str(element))
-                if removed >= trim:
-                    break
-            soup.append(read_more)
-        return str(soup), len_>max_length
+        return HtmlTools.summarize(soup, max_length, read_more)
 
     # in this version fead reader uses css selector to get feeds.
     # 
@@ -243,244 +249,328 @@ class BotHandler:
     #   - format: feed/{selector}, content/{selector}, title/{regex}, none
     # - remove-elements-selector: skip any element that has this attribute
 
-    def read_feed(self, index=0):
-        feeds_page = None
+    def read_feed(self, index=0, source: FeedSource = None, conditional = False):
+        source = source or self.sources[0]
+        items = None
         try:
-            feeds_page = self.get_feeds()
+            # all reads of a source share one download, a check must see
+            # changes so it only joins a download that is running
+            items = self.fetches.do(source.name, self.fetch_items, source, conditional,
+                fresh = 0 if conditional else None)
+            if items is None and not conditional:
+                # joined a check that found the feed not modified
+                items = self.fetches.do(source.name, self.fetch_items, source, False)
+        except SourceUnavailable as e:
+            self.logger.info(str(e))
+            return
         except Exception as e:
-            self.log_bug(e,'exception while trying to get last feed', False, True)
-            return None, None
-        
-        soup_page = Soup(feeds_page, self.feed_configs.get('feed-format', 'xml'))
-        feeds_list = soup_page.select(self.feed_configs['feeds-selector'])
-        self.logger.info(f'Got {len(feeds_list)} feeds')
-        title, link, content, time = None, None, None, None
-        for feed in feeds_list[index:]:
+            self.logger.warning(f'Could not get feeds of {source.name}: {e!r}')
+            return
+        if items is None:
+            # not modified
+            return
+        yield from itertools.islice(items, index, None)
+
+    def fetch_items(self, source: FeedSource, conditional = False):
+        'Download a source, returns its items that can be read by many threads or None'
+        feeds_page = self.get_feeds(source, conditional)
+        if feeds_page is None:
+            return None
+        return SharedIterator(self.extract_items(source, feeds_page))
+
+    def extract_items(self, source: FeedSource, feeds_page):
+        for feed in source.parse(feeds_page):
             try:
-                if self.__skip_field == 'feed':
-                    if self.__skip(feed):
-                        continue    #skip this feed
-
-                title_selector = self.feed_configs['title-selector']
-                if title_selector:
-                    # title-selector could be None (null)
-                    if self.feed_configs['title-attribute']:
-                        title = str(feed.select_one(title_selector).attrs[self.feed_configs['title-attribute']])
-                    else:
-                        title = str(feed.select_one(title_selector).text)
-
-                    if self.__skip_field == 'title':
-                        if self.__skip(title):
-                            continue
-
-                link_selector = self.feed_configs['link-selector']
-                if link_selector:
-                    # link-selector could be None (null)
-                    if self.feed_configs['link-attribute']:
-                        link = str(feed.select_one(link_selector).attrs[self.feed_configs['link-attribute']])
-                    else:
-                        link = str(feed.select_one(link_selector).text)
-
-                    if self.__skip_field == 'link':
-                        if self.__skip(link):
-                            continue
-                
-                time_selector = self.feed_configs['time-selector']
-                # date-selector could not be None (null)
-                if self.feed_configs['time-attribute']:
-                    time = str(feed.select_one(time_selector).attrs[self.feed_configs['time-attribute']])
-                else:
-                    time = str(feed.select_one(time_selector).text)
-
-                if time is None:
+                item = source.extract(feed)
+                if item is None:
+                    continue    #skip this feed
+                if item['date'] is None:
                     self.logger.error('The feed does not have a date, which means that the "date-selector" is not configured correctly')
                     self.logger.info('The feed was\n'+str(feed))
-                
-                content_selector = self.feed_configs['content-selector']
-                if content_selector:
-                    content = Soup(self.__get_content(feed.select(content_selector)[0]),features="lxml")
-
-                    if self.__skip_field == 'content':
-                        if self.__skip(content):
-                            continue
-                
             except Exception as e:
                 self.log_bug(e,'Exception while reading feed', feed = str(feed))
                 break
-        
-            yield {
-                'title': title,
-                'link': link,
-                'content': content,
-                'date': time
-                }
-
-    def render_feed(self, feed: dict, header: str):
-        title = feed['title']
-        self.logger.debug(f'Rendering feed {title}')
-        post_link = feed['link']
-        content = feed['content']
-        messages = [{
-            'type': 'text',
-            'text': header+'\n',
-            'markup': []
-        }]
-        if title:
-            title = f'<b>{title}</b>'
-            if post_link:
-                title = f'<a href="{post_link}">{title}</a>'
-            messages[0]['text']+=title
-        overflow = False
+
+            yield item
+
+    def render_feed(self, feed: dict):
+        'Messages of `feed` without a header'
+        self.logger.debug(f'Rendering feed {feed["title"]}')
         try:
-            if content:
-                #Remove elements with selector
-                remove_elem = self.feed_configs.get('remove-elements',[])
-                for elem in remove_elem:
-                    for e in content.select(elem):
-                        e.extract()
-                content = self.purge(content)
-                images = content.find_all('img')
-                first = True
-                self.logger.debug(f'Found {len(images)} images')
-
-                if not len(images):
-                    content, overflow = self.summarize(content, self.MAX_MSG_LEN, self.get_string('read-more'))
-                    messages[0]['text'] += '\n'+content
-                else:
-                    left, img_link, right = None, None, str(content)
-                    
-                    for img in images:
-                        last_message = messages[-1]
-                        split_by = str(img)
-                        if img.parent.name == 'a':
-                            split_by = str(img.parent)
-                            img_link = img.parent['href']
-                        left, right = right.split(split_by, 1)
-
-                        if first:
-                            if left:
-                                length = self.MAX_MSG_LEN if last_message['type'] == 'text' else self.MAX_CAP_LEN
-                                left, overflow = self.summarize(left, length, self.get_string('read-more'))
-                                last_message['text'] += '\n'+left
-                                if right and not overflow:
-                                    msg = {
-                                        'type': 'image',
-                                        'src': img['src'],
-                                        'text': '',
-                                        'markup': []
-                                    }
-                                    if img_link:
-                                        msg['markup'] = [[InlineKeyboardButton(self.get_string('image-link'), img_link)]]
-                                    messages.append(msg)
-                            else:
-                                last_message['type'] = 'image'
-                                last_message['src'] = img['src']
-                                if img_link:
-                                    last_message['markup'] = [[InlineKeyboardButton(self.get_string('image-link'), img_link)]]
-                            first = False
-                        else:
-                            length = self.MAX_MSG_LEN if last_message['type'] == 'text' else self.MAX_CAP_LEN
-                            left, overflow = self.summarize(left, length, self.get_string('read-more'))
-                            last_message['text'] += left
-                            if right and not overflow:
-                                msg = {
-                                    'type': 'image',
-                                    'src': img['src'],
-                                    'text': '',
-                                    'markup': []
-                                }
-                                if img_link:
-                                    msg['markup'] = [[InlineKeyboardButton(self.get_string('image-link'), img_link)]]
-                                messages.append(msg)
-                        if overflow:
-                            break
-                    #End for img
-                    if not overflow:
-                        length = self.MAX_MSG_LEN if messages[-1]['type'] == 'text' else self.MAX_CAP_LEN
-                        right, overflow = self.summarize(right, length, self.get_string('read-more'))
-                        messages[-1]['text'] += right
-                    
-                if post_link:
-                    messages[-1]['markup'].append([InlineKeyboardButton(self.get_string('goto-post'), post_link)])
-            return messages
+            return Rendering.render_body(feed, self.render_strings(), self.header_room(),
+                self.SUPPORTED_HTML_TAGS, self.SUPPORTED_TAG_ATTRS)
         except Exception as e:
-            self.log_bug(e,'Exception while rendering feed', feed = str(feed), messages = str(messages))
+            self.log_bug(e,'Exception while rendering feed', feed = str(feed))
             return None
 
-    def send_feed(self, messages, chats):
-        deathlist = [] #Delete IDs that are no longer available
+    def render_strings(self):
+        return {name: self.get_string(name) for name in Rendering.STRINGS}
+
+    def header_room(self):
+        'Length of the longest header, bodies of posts leave room for it'
+        return max(len(self.get_string(name)) for name in Rendering.HEADERS)
+
+    def render_key(self, source: FeedSource, feed: dict):
+        # the same item with an edited title or content is rendered again
+        digest = hashlib.blake2b(digest_size = 8)
+        for field in ('title', 'link', 'content'):
+            digest.update(str(feed[field]).encode())
+            digest.update(b'\0')
+        return (self.seen.key(source, feed), digest.digest(), self.language)
+
+    def get_body(self, source: FeedSource, feed: dict):
+        'Messages of `feed` without a header, rendered once for all headers'
+        key = self.render_key(source, feed)
+        messages = self.rendered.get(key)
+        if messages is None:
+            messages = self.render_feed(feed)
+            if messages:
+                self.rendered.put(key, messages)
+        return messages
+
+    def get_rendered(self, source: FeedSource, feed: dict, header_name):
+        'Messages of `feed` with `header_name` string'
+        return Rendering.add_header(self.get_body(source, feed), self.get_string(header_name))
+
+    def render_async(self, source: FeedSource, feed: dict, header_name):
+        'A future of messages of `feed`, rendered in the render pool and cached'
+        key = self.render_key(source, feed)
+        header = self.get_string(header_name)
+        future = Future()
+        messages = self.rendered.get(key)
+        if messages is not None or self.render_pool is None:
+            future.set_result(Rendering.add_header(messages or self.get_body(source, feed), header))
+            return future
+
+        def done(rendering):
+            messages = None
+            try:
+                messages = rendering.result()
+                self.rendered.put(key, messages)
+            except Exception as e:
+                self.log_bug(e,'Exception while rendering feed', feed = str(feed))
+            future.set_result(Rendering.add_header(messages, header))
+
+        try:
+            self.render_pool.submit(
+                Rendering.render_body,
+                Rendering.portable(feed),
+                self.render_strings(),
+                self.header_room(),
+                self.SUPPORTED_HTML_TAGS,
+                self.SUPPORTED_TAG_ATTRS
+            ).add_done_callback(done)
+        except Exception as e:
+            # the pool is broken or shut down
+            self.logger.warning(f'Can not use render processes: {e}')
+            future.set_result(self.get_rendered(source, feed, header_name))
+        return future
+
+    def last_feed_messages(self, source: FeedSource):
+        'Messages of the newest item of `source`, the feed is downloaded only if it is not cached'
+        feed = self.latest.get(source.name)
+        if feed is None:
+            feed = next(self.read_feed(source = source), None)
+            if feed is None:
+                return None
+            self.latest.put(source.name, feed)
+        return self.get_rendered(source, feed, 'last-feed')
+
+    def send_feed(self, messages, chats, on_done = None):
+        if not messages:
+            return None
+        report = None
         try:
-            for chat_id, chat_data in chats:
-                for msg in messages:
-                    try:
-                        if msg['type'] == 'text':
-                            self.bot.send_message(
-                                chat_id,
-                                msg['text'],
-                                parse_mode = ParseMode.HTML,
-                                reply_markup = InlineKeyboardMarkup(msg['markup']) if msg['markup'] else None,
-                                disable_web_page_preview = True
-                            )
-                        elif msg['type'] == 'image':
-                            if msg['text'] == '':
-                                msg['text'] = None
-                            self.bot.send_photo(
-                                chat_id,
-                                msg['src'],
-                                msg['text'],
-                                parse_mode = ParseMode.HTML,
-                                reply_markup = InlineKeyboardMarkup(msg['markup']) if msg['markup'] else None
-                            )
-                    except Unauthorized as e:
-                        self.log_bug(e,'handled an exception while sending a feed to a user. removing chat', report=False, chat_id = chat_id, chat_data = chat_data)
-                        deathlist.append(chat_id)
-                        break
-                    except Exception as e:
-                        self.log_bug(e, 'Exception while sending a feed to a user', message = msg, chat_id = chat_id, chat_data = chat_data)
-                        break
+            report = self.broadcaster.broadcast(messages, chats, on_done)
         except Exception as e:
             self.log_bug(e,'Exception while trying to send feed', messages = messages)
+            return None
 
-        for chat_id in deathlist:
-            with self.env.begin(self.chats_db, write = True) as txn:
-                txn.delete(str(chat_id).encode())
-
-    def iter_all_chats(self):
-        deathlist = []
-        with env.begin(self.chats_db) as txn:
-            for key, value in txn.cursor():
-                data = pickle.loads(value)
-                if not isinstance(data,dict):
-                    deathlist.append(key)
-                    self.log_bug(ValueError('chat data is not a dict'), 'chat data is not a dict', data = data)
-                    continue
-                yield key.decode(), data
-        with env.begin(self.chats_db, write = True) as txn:
-            for key in deathlist:
-                txn.delete(key.encode())
-
-    def check_new_feed(self):
-        last_date = self.get_data('last-feed-date', DB = self.data_db)
+        #Delete IDs that are no longer available
+        for chat_id in report.dead:
+            self.chats.delete(chat_id)
+        return report
+
+    def send_to_all(self, messages, job_id = None, exclude = None, seen = None):
+        '''Send `messages` to all chats (except chat `exclude`) through the outbox.
+
+        If the bot stops before the end, the broadcast is resumed by
+        `resume_broadcasts` and chats that got the messages are skipped.
+        Items of `seen` are marked as seen with the job, so a restart never
+        sends them again as new posts.'''
+        if not messages:
+            if seen:
+                self.seen.add(seen)
+            return None
+        if job_id is None:
+            on_add = None if not seen else lambda txn: self.seen.add(seen, txn)
+            job_id = self.outbox.add(messages, on_add)
+            if exclude is not None:
+                self.outbox.done(job_id, exclude)
+                self.outbox.checkpoint()
+        chats = self.outbox.pending(job_id, self.chats.iterate())
+        report = self.send_feed(messages, chats, on_done = lambda chat_id: self.outbox.done(job_id, chat_id))
+        if report is not None:
+            self.outbox.finish(job_id)
+        return report
+
+    def resume_broadcasts(self):
+        for job_id, messages in list(self.outbox.jobs()):
+            self.logger.info(f'Resuming broadcast {job_id}')
+            try:
+                self.send_to_all(messages, job_id)
+            except Exception as e:
+                self.log_bug(e, 'Exception while resuming a broadcast', job_id = job_id)
+
+    def find_source(self, name = None) -> FeedSource:
+        'Source with this name, or the first source'
+        if name is None:
+            return self.sources[0]
+        for source in self.sources:
+            if source.name == name:
+                return source
+        return None
+
+    def check_source(self, source: FeedSource):
+        last_date = self.get_data(source.key('last-feed-date'), DB = self.data_db)
         new_date = last_date
-        for feed in self.read_feed():
-            date = parse_date(feed['date']) if feed['date'] else None
-            if date is None or last_date is not None and last_date < date:
-                new_date = max(date, new_date)
-                self.logger.info(f'Sending new feed. date: {date}')
-                messages = self.render_feed(feed, header= self.get_string('new-feed'))
-                self.send_feed(messages, self.iter_all_chats())
-            if date is None or last_date is None or date <= last_date:
-                self.logger.info('No more new feeds')
-                break
-        self.set_data('last-feed-date', new_date, DB = self.data_db)
-        if self.__check:
-            self.logger.info(f'Checking for new feeds in {self.interval} seconds')
-            self.check_thread = Timer(self.interval, self.check_new_feed)
-            self.check_thread.start()
-
+        # first check of this source: just remember feeds that are there
+        bootstrap = last_date is None and self.seen.is_empty(source)
+        # index is empty but an older version saved last-feed-date
+        by_date = not bootstrap and last_date is not None and self.seen.is_empty(source)
+        source.validators = None
+        newest = True
+        stamps = []
+        new = []
+        for feed in self.read_feed(source = source, conditional = True):
+            if newest:
+                self.latest.put(source.name, feed)
+                newest = False
+            date = self.dates.parse(feed['date'], source.name) if feed['date'] else None
+            if date is not None:
+                new_date = max(date, new_date) if new_date else date
+                stamps.append(date.timestamp())
+            key = self.seen.key(source, feed)
+            seen_at = self.seen.seen(key)
+            if seen_at is not None:
+                self.seen.touch(key, seen_at)
+                if date is not None and last_date is not None and date < last_date - self.lookback:
+                    # the rest of the feed is older
+                    break
+                continue
+
+            if bootstrap or by_date and date is not None and date <= last_date:
+                self.seen.add([key])
+                continue
+            new.append((key, feed, date))
+
+        # new posts are sent after the page is read, a streamed download is
+        # not left waiting while a post is broadcast (that can take minutes).
+        # A new post is rendered while the one before it is being sent, posts
+        # are sent in the order they are found by a single sender thread
+        sent = 0
+        if new:
+            pipeline = queue.Queue(self.PIPELINE_DEPTH)
+            sender = Thread(target = self.send_new_feeds, args = (source, pipeline), name = 'send-'+source.name)
+            sender.start()
+            try:
+                for key, feed, date in new:
+                    self.logger.info(f'Sending new feed of {source.name}. date: {date}')
+                    pipeline.put((key, self.render_async(source, feed, 'new-feed')))
+                    sent += 1
+            finally:
+                pipeline.put(None)
+                sender.join()
+        self.logger.info(f'No more new feeds in {source.name}, {sent} sent')
+        if new_date is not None:
+            self.set_data(source.key('last-feed-date'), new_date, DB = self.data_db)
+        if source.validators:
+            # saved after sending, so a failed check will download the feed again
+            etag, last_modified = source.validators
+            self.set_data(source.key('etag'), etag, DB = self.data_db)
+            self.set_data(source.key('last-modified'), last_modified, DB = self.data_db)
+        retry_in = source.breaker.retry_in()
+        if retry_in is not None:
+            # the download failed, try again without waiting for the next check
+            self.scheduler.retry(self.check_job(source), retry_in)
+            self.logger.info(f'Trying {source.name} again in {retry_in:.0f} seconds')
+        if self.adaptive is not None and source.interval is None:
+            source.cadence.learn(stamps)
+            self.set_data(source.key('cadence'), source.cadence.state(), DB = self.data_db)
+            self.adapt_interval(source)
+
+    def send_new_feeds(self, source: FeedSource, pipeline: queue.Queue):
+        'Sender of `check_source`, sends rendered posts of `pipeline` until it gets None'
+        while True:
+            item = pipeline.get()
+            if item is None:
+                return
+            key, rendering = item
+            try:
+                self.send_to_all(rendering.result(), seen = [key])
+            except Exception as e:
+                self.log_bug(e, 'Exception while sending new feed', source = source.name)
+
+    @staticmethod
+    def check_job(source: FeedSource):
+        return 'check '+source.name
+
+    def check_interval(self, source: FeedSource):
+        'Interval of the source, or learned from its posts, or the global interval'
+        if source.interval is not None:
+            return source.interval
+        if self.adaptive is not None:
+            interval = source.cadence.interval(
+                time.time(),
+                self.adaptive.get('min', 60),
+                self.adaptive.get('max', 3600),
+                self.adaptive.get('factor', 0.5))
+            if interval is not None:
+                return interval
+        return self.interval
+
+    def adapt_interval(self, source: FeedSource):
+        name = self.check_job(source)
+        if name not in self.scheduler.jobs:
+            # checked before the checks are scheduled
+            return
+        old = self.scheduler.info(name)['interval']
+        interval = self.check_interval(source)
+        # small changes are not worth moving the next check
+        if abs(interval - old) > old / 10:
+            self.scheduler.set_interval(name, interval)
+            self.logger.info(f'Interval of {source.name} changed to {interval:.0f} seconds')
+
+    def schedule_checks(self):
+        for source in self.sources:
+            self.scheduler.add(
+                self.check_job(source),
+                partial(self.try_check_source, source),
+                self.check_interval(source),
+                self.check_jitter)
+        self.scheduler.add('evict seen index', self.evict_seen, 3600, delay = 3600)
+
+    def set_interval(self, interval):
+        'Change interval of sources that do not have their own or a learned one, a running check is not waited for'
+        self.interval = interval
+        for source in self.sources:
+            if source.interval is None:
+                self.scheduler.set_interval(self.check_job(source), self.check_interval(source))
+        self.set_data('interval', interval, DB = self.data_db)
+        self.logger.info('Interval changed to '+str(interval))
+
+    def evict_seen(self):
+        removed = self.seen.evict()
+        self.logger.info(f'Removed {removed} old items from seen index')
+
+    def try_check_source(self, source: FeedSource):
+        try:
+            self.check_source(source)
+        except Exception as e:
+            self.log_bug(e, 'Exception while checking for new feeds', source = source.name)
 
     def get_data(self, key, default = None, DB = None, do = lambda data: pickle.loads(data)):
-        DB = DB if DB else self.chats_db
+        DB = DB if DB else self.data_db
         data = None
         with self.env.begin(DB) as txn:
             data = txn.get(key.encode(), default)
@@ -490,7 +580,7 @@ class BotHandler:
             return data
 
     def set_data(self, key, value, DB = None, over_write = True, do = lambda data: pickle.dumps(data)):
-        DB = DB if DB else self.chats_db
+        DB = DB if DB else self.data_db
         if not callable(do):
             do = lambda data: data
         with self.env.begin(DB, write = True) as txn:
@@ -501,17 +591,21 @@ class BotHandler:
 
     def run(self):
         self.updater.start_polling()
+        # broadcasts that were stopped by a restart
+        self.resume_broadcasts()
         # check for new feed
-        self.check_new_feed()
+        self.schedule_checks()
+        self.scheduler.start()
 
     def idle(self):
         self.updater.idle()
         self.updater.stop()
-        self.__check = False
-        self.check_thread.cancel()
-        if self.check_thread.is_alive():
-            print('waiting for check thread to finish')
-            self.check_thread.join()
+        print('waiting for running checks to finish')
+        self.scheduler.stop()
+        self.http.close()
+        if self.render_pool:
+            self.render_pool.shutdown()
+        self.chats.close()
 
 
 if __name__ == '__main__':
@@ -524,6 +618,10 @@ if __name__ == '__main__':
     help='Reset stored data about chats or bot data',
     default=False,required=False,choices=('data','chats','all'))
 
+    parser.add_argument('-m','--migrate-chats',
+    help='Convert chats that are saved by older versions (pickle) to the new format',
+    action='store_true')
+
     parser.add_argument('-c','--config',
     help='Specify config file',
     default='user-config.jsonc', required=False, type=argparse.FileType('r'))
@@ -543,9 +641,12 @@ if __name__ == '__main__':
         format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         filename=log_file_name,
         level = logging._nameToLevel.get(config.get('log-level','INFO').upper(),logging.INFO))
-    env = lmdb.open(config.get('db-path','db.lmdb'), max_dbs = 3)
+    env = lmdb.open(config.get('db-path','db.lmdb'), max_dbs = 8)
     chats_db = env.open_db(b'chats')
     data_db = env.open_db(b'config')        #using old name for compatibility
+    file_ids_db = env.open_db(b'file-ids')
+    seen_db = env.open_db(b'seen')
+    outbox_db = env.open_db(b'outbox')
 
     if args.reset:
         answer = input(f'Are you sure you want to Reset all "{args.reset}"?(yes | anything else means no)')
@@ -563,6 +664,12 @@ if __name__ == '__main__':
             print('Reset done. now you can run the bot again')
             sys.exit()
 
+    if args.migrate_chats:
+        migrated, removed = Chats.migrate(env, chats_db)
+        print(f'{migrated} chats migrated, {removed} bad records removed')
+        Chats.reconcile(env, chats_db, data_db)
+        sys.exit()
+
     language = config.get('language','en-us')
     strings_file = config.get('strings-file', 'default-strings.json')
     checks=[
@@ -632,7 +739,11 @@ if __name__ == '__main__':
     if use_proxy:
         proxy_info = config.get('proxy-info')
 
-    bot_handler = BotHandler(token, config.get('feed-configs'), env, chats_db, data_db, strings, bug_reporter_config != 'off', debug, proxy_info)
+    bot_handler = BotHandler(token, config.get('feed-configs'), env, chats_db, data_db, file_ids_db, strings, bug_reporter_config != 'off', debug, proxy_info, config.get('broadcast'), config.get('feed-workers', 8), seen_db, config.get('seen-index'),
+        language, config.get('render-cache'), config.get('feed-freshness', 30),
+        config.get('chats-flush-interval', 1), outbox_db, config.get('render-workers', 2),
+        config.get('check-jitter', 5), config.get('adaptive-interval'), config.get('circuit-breaker'),
+        config.get('http'))
     bot_handler.run()
     bot_handler.idle()
     if bug_reporter_config != 'off':
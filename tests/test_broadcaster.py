@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import NetworkError, RetryAfter, Unauthorized
+
+from Broadcaster import Broadcaster
+
+MESSAGES = [{'type': 'text', 'text': 'post'}]
+
+
+class FakeBot:
+    def __init__(self, blocked = (), broken = ()):
+        self.blocked = set(blocked)
+        self.broken = set(broken)
+        self.sent = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise Unauthorized('Forbidden: bot was blocked by the user')
+        if chat_id in self.broken:
+            raise NetworkError('Bad Gateway')
+        self.sent.append(chat_id)
+        return SimpleNamespace(photo = None)
+
+
+class BroadcastTest(unittest.TestCase):
+    def broadcast(self, bot, chats, on_error):
+        broadcaster = Broadcaster(bot, workers = 4, global_rate = 1000, chat_rate = 1000, on_error = on_error)
+        done = []
+        report = broadcaster.broadcast(MESSAGES, [(chat_id, {}) for chat_id in chats], done.append)
+        return report, done
+
+    def test_failed_chats(self):
+        errors = []
+        bot = FakeBot(blocked = range(0, 10, 2), broken = (1, 3))
+        report, done = self.broadcast(bot, range(10), lambda *args, **kwargs: errors.append(kwargs))
+        self.assertEqual(sorted(bot.sent), [5, 7, 9])
+        self.assertEqual(sorted(report.dead), [0, 2, 4, 6, 8])
+        self.assertEqual(report.failed, 2)
+        self.assertEqual(sorted(done), list(range(10)))
+        # blocked chats are not errors, failed chats are reported once
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(errors[0]['errors']), 2)
+
+    def test_on_error_raises(self):
+        def on_error(*args, **kwargs):
+            raise RetryAfter(5)
+        bot = FakeBot(blocked = range(0, 10, 2), broken = (1,))
+        report, done = self.broadcast(bot, range(10), on_error)
+        self.assertEqual(sorted(done), list(range(10)))
+        self.assertEqual(report.failed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Feeds import FeedSource
+
+DC_FEED = b'''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:dc="http://purl.org/dc/elements/1.1/"><channel><title>Test</title>
+<item><title>First</title><link>http://example.com/1</link><dc:date>2023-11-27T08:09:10Z</dc:date>
+<dc:creator>Ali</dc:creator><description>one</description></item>
+<item><title>Second</title><link>http://example.com/2</link><dc:date>2023-11-26T08:09:10Z</dc:date>
+<dc:creator>Sara</dc:creator><description>two</description></item>
+</channel></rss>'''
+
+
+def read(source, page):
+    return [source.extract(feed) for feed in source.parse(page)]
+
+
+class SelectorTest(unittest.TestCase):
+    def test_namespaces_of_page(self):
+        # prefixes declared by the page work without `namespaces` in the configs
+        for streaming in (False, True):
+            with self.subTest(streaming = streaming):
+                source = FeedSource({'source': 'test', 'time-selector': 'dc|date', 'streaming': streaming})
+                items = read(source, DC_FEED)
+                self.assertEqual([item['date'] for item in items], ['2023-11-27T08:09:10Z', '2023-11-26T08:09:10Z'])
+
+    def test_feed_skip_condition_with_namespace(self):
+        source = FeedSource({'source': 'test', 'time-selector': 'dc|date',
+            'feed-skip-condition': 'feed/dc|creator:-soup-contains("Sara")'})
+        self.assertEqual([item and item['title'] for item in read(source, DC_FEED)], ['First', None])
+
+    def test_configured_namespaces(self):
+        source = FeedSource({'source': 'test', 'time-selector': 'd|date',
+            'namespaces': {'d': 'http://purl.org/dc/elements/1.1/'}})
+        self.assertEqual(read(source, DC_FEED)[0]['date'], '2023-11-27T08:09:10Z')
+
+
+class StreamingTest(unittest.TestCase):
+    def test_broken_feed(self):
+        # an entity that xml does not know, a streamed page is read like a whole one
+        page = (b'<rss><channel>'
+            b'<item><title>A&nbsp;B</title><link>http://example.com/1</link><pubDate>x</pubDate><description>1</description></item>'
+            b'<item><title>C</title><link>http://example.com/2</link><pubDate>y</pubDate><description>2</description></item>'
+            b'</channel></rss>')
+        for feed_format in ('xml', 'rss'):
+            with self.subTest(feed_format = feed_format):
+                whole = read(FeedSource({'source': 'test', 'feed-format': feed_format}), page)
+                streamed = read(FeedSource({'source': 'test', 'feed-format': feed_format, 'streaming': True}), page)
+                self.assertEqual([item['title'] for item in streamed], [item['title'] for item in whole])
+                self.assertEqual(len(streamed), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
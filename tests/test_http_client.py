@@ -0,0 +1,163 @@
+import gzip
+import os
+import socket
+import sys
+import time
+import unittest
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from HttpClient import BodyTooLarge, HttpClient, HttpError
+
+BODY = b'<rss><channel><title>Test</title></channel></rss>' * 100
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, body, status = 200, **headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name.replace('_', '-'), value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        self.server.requests.append(self.path)
+        if self.path == '/feed':
+            self.send_body(BODY)
+        elif self.path == '/gzip':
+            self.send_body(gzip.compress(BODY), Content_Encoding = 'gzip')
+        elif self.path == '/deflate':
+            self.send_body(zlib.compress(BODY), Content_Encoding = 'deflate')
+        elif self.path == '/raw-deflate':
+            compressor = zlib.compressobj(wbits = -zlib.MAX_WBITS)
+            self.send_body(compressor.compress(BODY) + compressor.flush(), Content_Encoding = 'deflate')
+        elif self.path == '/etag':
+            if self.headers.get('If-None-Match') == ETAG:
+                self.send_response(304)
+                self.send_header('ETag', ETAG)
+                self.end_headers()
+            else:
+                self.send_body(BODY, ETag = ETAG)
+        elif self.path == '/slow':
+            time.sleep(1)
+            self.send_body(BODY)
+        elif self.path.startswith('/redirect/'):
+            count = int(self.path.rsplit('/', 1)[1])
+            self.send_body(b'', 302, Location = f'/redirect/{count - 1}' if count else '/feed')
+        elif self.path == '/loop':
+            self.send_body(b'', 301, Location = '/loop')
+        else:
+            self.send_body(b'not found', 404)
+
+
+class HttpClientTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.server.daemon_threads = True
+        Thread(target = cls.server.serve_forever, daemon = True).start()
+        cls.base = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.connections = set()
+        self.server.requests = []
+        self.client = HttpClient(connect_timeout = 2, read_timeout = 2, max_redirects = 3)
+        self.client.proxies = dict()
+
+    def tearDown(self):
+        self.client.close()
+
+    def get(self, path, **kw):
+        with self.client.request(self.base + path, **kw) as response:
+            return response.status, response.read()
+
+    def test_keep_alive(self):
+        for _ in range(3):
+            self.assertEqual(self.get('/feed'), (200, BODY))
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_partial_read(self):
+        response = self.client.request(self.base + '/feed')
+        self.assertEqual(response.read(10), BODY[:10])
+        self.assertEqual(response.read(10), BODY[10:20])
+        self.assertEqual(response.read(), BODY[20:])
+
+    def test_decoding(self):
+        for path in ('/gzip', '/deflate', '/raw-deflate'):
+            with self.subTest(path):
+                self.assertEqual(self.get(path), (200, BODY))
+
+    def test_max_body(self):
+        with self.assertRaises(BodyTooLarge):
+            self.client.request(self.base + '/feed', max_body = 100)
+        # the length of a compressed body is known only while it is read
+        response = self.client.request(self.base + '/gzip', max_body = 100)
+        with self.assertRaises(BodyTooLarge):
+            response.read()
+        self.assertTrue(response.closed)
+        self.assertEqual(self.client.pools, dict())
+
+    def test_read_timeout(self):
+        self.client.read_timeout = 0.2
+        with self.assertRaises(socket.timeout):
+            self.client.request(self.base + '/slow')
+
+    def test_not_modified(self):
+        response = self.client.request(self.base + '/etag')
+        self.assertEqual(response.headers['ETag'], ETAG)
+        self.assertEqual(response.read(), BODY)
+        status, body = self.get('/etag', headers = {'If-None-Match': ETAG})
+        self.assertEqual((status, body), (304, b''))
+        # a 304 has no body, the connection is still used
+        self.assertEqual(self.get('/feed'), (200, BODY))
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_redirects(self):
+        response = self.client.request(self.base + '/redirect/2')
+        self.assertEqual(response.url, self.base + '/feed')
+        self.assertEqual(response.read(), BODY)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_redirect_limit(self):
+        with self.assertRaises(HttpError) as raised:
+            self.client.request(self.base + '/loop')
+        self.assertEqual(raised.exception.status, 301)
+        self.assertEqual(len(self.server.requests), self.client.max_redirects + 1)
+
+    def test_error(self):
+        with self.assertRaises(HttpError) as raised:
+            self.client.request(self.base + '/missing')
+        self.assertEqual(raised.exception.status, 404)
+        # the small body of the error is skipped and the connection is used again
+        self.assertEqual(self.get('/feed'), (200, BODY))
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_close_unread(self):
+        response = self.client.request(self.base + '/feed')
+        response.read(10)
+        response.close()
+        # the rest of the body is still in the connection, it is not reused
+        self.assertEqual(self.client.pools, dict())
+        self.assertEqual(self.get('/feed'), (200, BODY))
+        self.assertEqual(len(self.server.connections), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import logging
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Handlers  # main imports Handlers, and Handlers imports main
+from main import BotHandler
+from Scheduler import Scheduler
+
+
+class AdaptIntervalTest(unittest.TestCase):
+    'A check changes the interval of its own job, while that job is running'
+
+    def setUp(self):
+        self.scheduler = Scheduler(1)
+        self.source = SimpleNamespace(name = 'source')
+        self.learned = 600
+        self.handler = SimpleNamespace(
+            scheduler = self.scheduler,
+            check_job = BotHandler.check_job,
+            check_interval = lambda source: self.learned,
+            logger = logging.getLogger('test'))
+        self.job = self.scheduler.add(BotHandler.check_job(self.source), self.check, 300)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def check(self):
+        BotHandler.adapt_interval(self.handler, self.source)
+
+    def run_job(self, retrying = False):
+        # what the loop of the scheduler does when the job is due
+        self.job.running = True
+        self.job.retrying = retrying
+        self.scheduler.run(self.job)
+
+    def test_next_run_is_last_slot_plus_new_interval(self):
+        slot = self.job.scheduled
+        self.run_job()
+        self.assertEqual(self.job.interval, 600)
+        self.assertEqual(self.job.scheduled, slot + 600)
+        self.assertGreaterEqual(self.job.due, slot + 600)
+
+    def test_shorter_interval(self):
+        self.learned = 120
+        slot = self.job.scheduled
+        self.run_job()
+        self.assertEqual(self.job.scheduled, slot + 120)
+
+    def test_small_change_keeps_interval(self):
+        self.learned = 310
+        slot = self.job.scheduled
+        self.run_job()
+        self.assertEqual(self.job.interval, 300)
+        self.assertEqual(self.job.scheduled, slot + 300)
+
+    def test_retry(self):
+        slot = self.job.scheduled
+        self.run_job()
+        # a retry runs between slots, the next slot is moved to the new interval
+        self.learned = 1200
+        self.run_job(retrying = True)
+        self.assertEqual(self.job.interval, 1200)
+        self.assertEqual(self.job.scheduled, slot + 1200)
+
+
+if __name__ == '__main__':
+    unittest.main()